@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class ChitChatConfig(AppConfig):
+    name = 'chit_chat'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,99 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .ckc_conf import chat_settings
+
+
+class MembershipCache:
+    """Rooms per user pk as `{room pk: member count}`, kept in process memory as an LRU with
+    a TTL.
+
+    Membership signals invalidate entries for changes made in this process, changes made in
+    other processes are picked up once the TTL runs out (or sooner, through the room delta
+    carried by `refresh_group_add` events)."""
+
+    def __init__(self):
+        # Written from ORM signals in sync threads and read from the consumers' event loop
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_pk):
+        with self._lock:
+            entry = self._entries.get(user_pk)
+            if entry is None:
+                return None
+            expires, rooms = entry
+            if expires < time.monotonic():
+                del self._entries[user_pk]
+                return None
+            self._entries.move_to_end(user_pk)
+            return rooms
+
+    def set(self, user_pk, rooms):
+        options = chat_settings['MEMBERSHIP_CACHE']
+        with self._lock:
+            self._entries[user_pk] = (time.monotonic() + options['TTL'], dict(rooms))
+            self._entries.move_to_end(user_pk)
+            while len(self._entries) > options['MAX_SIZE']:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_pks):
+        with self._lock:
+            for user_pk in user_pks:
+                self._entries.pop(user_pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+membership_cache = MembershipCache()
+
+
+class RoomListCache:
+    """Room list responses per user, in the django cache named by ROOM_LIST_CACHE.
+
+    Every user has a version, a random token that is replaced whenever anything in one of
+    their rooms changes (see `RoomMembershipQuerySet.invalidate_room_lists`). Responses are
+    stored under the version they were built from, so a response that was being built while
+    the version changed is never served, and the version doubles as the response's ETag."""
+
+    def _get_cache(self):
+        return caches[chat_settings['ROOM_LIST_CACHE']['CACHE']]
+
+    def _get_version_key(self, user_pk):
+        return f'chit_chat:room_list:{user_pk}'
+
+    def get_etag(self, user_pk, variant):
+        """ETag of the user's current room list, `variant` tells apart the different requests
+        (query strings, formats) for it."""
+        cache, key = self._get_cache(), self._get_version_key(user_pk)
+        ttl = chat_settings['ROOM_LIST_CACHE']['TTL']
+        version = cache.get(key)
+        if version is None:
+            # Someone else may be adding one as well, theirs wins
+            cache.add(key, uuid.uuid4().hex, ttl)
+            version = cache.get(key)
+        return '"%s"' % hashlib.sha1(f'{version}:{variant}'.encode()).hexdigest()
+
+    def get(self, user_pk, etag):
+        return self._get_cache().get(f'{self._get_version_key(user_pk)}:{etag}')
+
+    def set(self, user_pk, etag, data):
+        self._get_cache().set(f'{self._get_version_key(user_pk)}:{etag}', data, chat_settings['ROOM_LIST_CACHE']['TTL'])
+
+    def invalidate(self, *user_pks):
+        if user_pks:
+            version = uuid.uuid4().hex
+            self._get_cache().set_many(
+                {self._get_version_key(user_pk): version for user_pk in user_pks},
+                chat_settings['ROOM_LIST_CACHE']['TTL'],
+            )
+
+
+room_list_cache = RoomListCache()
@@ -14,23 +14,153 @@ class ImportDict(dict):
         return val
 
 
+# Plain settings, each one overridable with a `CKC_CHAT_<NAME>` django setting.
+DEFAULTS = {
+    # How many of the latest messages to embed per room when listing rooms, None embeds
+    # the whole history. Clients can override this with `?message_limit=N`.
+    'ROOM_MESSAGE_LIMIT': None,
+
+    # Most users listed as choices for room members, i.e. in the browsable API's form.
+    'CHOICES_LIMIT': 1000,
+
+    # Most changelog entries, and most messages, returned per page of `GET /chatrooms/sync/`.
+    'SYNC_PAGE_SIZE': 500,
+
+    # Per process cache of the rooms each connected user belongs to, saves a query on every
+    # websocket connect. Partial overrides are merged with these defaults.
+    'MEMBERSHIP_CACHE': {
+        'MAX_SIZE': 10000,
+        'TTL': 60,  # seconds
+    },
+
+    # `GET /chatrooms/` responses are cached per user in this django cache for up to TTL
+    # seconds and answered with 304 while unchanged. Messages and membership changes clear a
+    # user's entries right away, edits to members' profiles only show once TTL runs out.
+    # Off unless ENABLED, as it needs a cache shared by every process that saves messages or
+    # serves the room list (e.g. redis or memcached). With a per process cache like the
+    # stock LocMemCache, the other processes keep serving stale lists until TTL.
+    'ROOM_LIST_CACHE': {
+        'ENABLED': False,
+        'CACHE': 'default',
+        'TTL': 300,  # seconds
+    },
+
+    # Rooms with at least this many members are delivered through one channel layer group
+    # membership per process instead of one per socket, see `chit_chat.relay`. Sending to such
+    # a room costs a channel layer message per process rather than per member. None turns
+    # this off.
+    'LARGE_ROOM_MEMBERS': 1000,
+
+    # Max channel layer group_add/group_discard calls in flight per socket while joining or
+    # leaving its rooms.
+    'GROUP_CONCURRENCY': 50,
+
+    # Typing indicators are ephemeral, a socket's repeated "still typing" for a room within
+    # INTERVAL seconds is dropped instead of fanned out.
+    'TYPING': {
+        'INTERVAL': 3,  # seconds
+    },
+
+    # Presence is ephemeral too, kept in the given django cache for TTL seconds. Each socket
+    # broadcasts its user's status at most every INTERVAL seconds, whatever it changes to, and
+    # only the latest one received in between. Users are online while they have a socket open
+    # anywhere, each process refreshes its users' entries every third of TTL.
+    'PRESENCE': {
+        'CACHE': 'default',
+        'INTERVAL': 5,  # seconds
+        'TTL': 300,  # seconds
+    },
+
+    # `read` receipts from websocket clients are merged for this long, then saved together and
+    # announced with one event per room.
+    'READ_RECEIPTS': {
+        'FLUSH_INTERVAL': 0.5,  # seconds
+    },
+
+    # Token buckets checked before anything else is done with an incoming frame, RATE frames
+    # per second with bursts of up to BURST. Each socket and each user (across their sockets
+    # in this process) is limited on every frame, each room on the chat messages sent to it.
+    # Set a scope to None to turn its limit off, or override just its RATE or BURST.
+    'RATE_LIMITS': {
+        'SOCKET': {'RATE': 5, 'BURST': 20},
+        'USER': {'RATE': 10, 'BURST': 40},
+        'ROOM': {'RATE': 50, 'BURST': 100},
+    },
+
+    # Import path of the codec used for websocket frames, see `chit_chat.codecs`. None uses
+    # orjson or msgspec when installed, falling back to the json module.
+    'JSON_CODEC': None,
+
+    # Broadcast chat messages as soon as they are validated and save them in the background,
+    # in batches. See `chit_chat.writer` for what that means for durability. Validation then
+    # runs on the event loop, so a custom MESSAGE serializer must not query the database.
+    'WRITE_BEHIND': {
+        'ENABLED': False,
+        'BATCH_SIZE': 100,  # flush once this many messages are queued..
+        'FLUSH_INTERVAL': 0.05,  # ..or this many seconds after the first one was
+        'MAX_QUEUE_SIZE': 10000,  # senders wait for room in the queue once it's this full
+    },
+
+    # Sockets connecting with `?last_seen=<room>:<message id>,..` are first sent the chat
+    # messages they missed in those rooms. The latest BUFFER_SIZE messages of each room are
+    # kept in memory for that, older ones are read from the database. Past MAX_MESSAGES in a
+    # room the client is told to refetch it instead.
+    'REPLAY': {
+        'BUFFER_SIZE': 100,
+        'MAX_MESSAGES': 500,
+    },
+
+    # How long messages are kept, applied by the `prune_messages` management command. DAYS is
+    # the default for rooms without their own `retention_days`, None keeps messages forever.
+    # With ARCHIVE_DIR set, `prune_messages --archive` moves them to gzipped JSONL files there
+    # instead, which the messages endpoint reads back when clients scroll that far.
+    'RETENTION': {
+        'DAYS': None,
+        'BATCH_SIZE': 1000,  # messages deleted per transaction..
+        'SLEEP': 0.1,  # ..with this many seconds between them
+        'ARCHIVE_DIR': None,
+    },
+
+    # Members without a socket open (counted in the PRESENCE cache) are sent digests of the
+    # messages they missed, through BACKEND (an import path, see `chit_chat.notifications`).
+    # Each member gets at most one per room every DIGEST_INTERVAL seconds, listing the newest
+    # MAX_MESSAGES. Muted and archived rooms are skipped. None turns notifications off.
+    'NOTIFICATIONS': {
+        'BACKEND': None,
+        'DIGEST_INTERVAL': 60,  # seconds
+        'MAX_MESSAGES': 5,
+    },
+}
+
+
 chat_settings = {
     'SERIALIZERS': ImportDict({
         # NOTE: these are referenced like chat_settings.USER (as attribute, not dict key!)
         'USER': 'chit_chat.serializers.ChatUserSerializer',
         'MESSAGE': 'chit_chat.consumer_serializers.ChatMessageSerializer',
-    })
+    }),
+    **DEFAULTS,
 }
 
 
+def merge_settings(default, value):
+    """`value` with whatever it leaves out taken from `default`, at every level of nesting."""
+    if not isinstance(default, dict) or not isinstance(value, dict):
+        return value
+    return {**default, **{key: merge_settings(default.get(key), item) for key, item in value.items()}}
+
+
 def load_or_reload_settings(setting=None, **kwargs):
-    if setting is not None and setting != 'CKC_CHAT_SERIALIZERS':
+    if setting is not None and not setting.startswith('CKC_CHAT_'):
         return
     # Override default serializers..
     if hasattr(settings, 'CKC_CHAT_SERIALIZERS'):
         for name, module in settings.CKC_CHAT_SERIALIZERS.items():
             chat_settings['SERIALIZERS'][name] = module
 
+    for name, default in DEFAULTS.items():
+        chat_settings[name] = merge_settings(default, getattr(settings, f'CKC_CHAT_{name}', default))
+
 
 load_or_reload_settings()
 
@@ -0,0 +1,143 @@
+import json
+
+from django.utils.module_loading import import_string
+
+from chit_chat.ckc_conf import chat_settings
+
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class StdlibJSONCodec:
+    invalid_message = 'Invalid JSON.'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+
+class OrjsonCodec:
+    invalid_message = StdlibJSONCodec.invalid_message
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode()
+
+
+class MsgspecJSONCodec:
+    invalid_message = StdlibJSONCodec.invalid_message
+
+    def __init__(self):
+        self.encoder = msgspec.json.Encoder(enc_hook=str)
+        self.decoder = msgspec.json.Decoder()
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj).decode()
+
+
+# Top level keys are shortened on the wire for binary clients
+SHORT_KEYS = {
+    'type': 'y',
+    'message_type': 'm',
+    'room': 'r',
+    'user': 'u',
+    'text': 't',
+    'time': 'w',
+    'id': 'i',
+    'uuid': 'q',
+    'users_who_viewed': 'v',
+    'is_typing': 'k',
+    'status': 's',
+    'last_seen': 'l',
+    'readers': 'd',
+    'non_field_errors': 'e',
+    'field_errors': 'f',
+    'retry_after': 'a',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+
+class MsgpackCodec:
+    """Binary codec for clients connecting with the `chit-chat.msgpack` subprotocol,
+    `dumps` returns bytes."""
+    invalid_message = 'Invalid MessagePack.'
+
+    def loads(self, data):
+        try:
+            obj = msgpack.unpackb(data)
+        except (TypeError, ValueError, msgpack.UnpackException) as e:
+            raise ValueError(str(e)) from e
+        if not isinstance(obj, dict):
+            return obj
+        return {LONG_KEYS.get(key, key): value for key, value in obj.items()}
+
+    def dumps(self, obj):
+        return msgpack.packb({SHORT_KEYS.get(key, key): value for key, value in obj.items()})
+
+
+def get_default_json_codec_class():
+    if orjson is not None:
+        return OrjsonCodec
+    if msgspec is not None:  # pragma: no cover
+        return MsgspecJSONCodec
+    return StdlibJSONCodec  # pragma: no cover
+
+
+_json_codecs = {}
+msgpack_codec = MsgpackCodec() if msgpack is not None else None
+
+
+def get_json_codec():
+    """Codec for websocket frames, `loads` raises ValueError on invalid input and `dumps`
+    returns a str. JSON_CODEC picks one by import path, defaulting to the fastest installed."""
+    path = chat_settings['JSON_CODEC']
+    if path not in _json_codecs:
+        _json_codecs[path] = (import_string(path) if path else get_default_json_codec_class())()
+    return _json_codecs[path]
+
+
+def encode_event(payload):
+    """Channel layer event for `payload`, serialized here once in every format instead of once
+    per socket it reaches."""
+    event = {
+        'type': payload['type'],
+        'user': payload.get('user'),
+        'room': payload.get('room'),
+        'id': payload.get('id'),
+        'text_data': get_json_codec().dumps(payload),
+    }
+    if msgpack_codec is not None:
+        event['bytes_data'] = msgpack_codec.dumps(payload)
+    return event
+
+
+def ensure_encoded(event):
+    """`event` with the frames `encode_event` adds, for events built by hand in the plain
+    payload shape, i.e. `{"type": "chat", "room": 1, "text": ..}`."""
+    if 'text_data' in event and ('bytes_data' in event or msgpack_codec is None):
+        return event
+    payload = get_json_codec().loads(event['text_data']) if 'text_data' in event else event
+    return encode_event(payload)
@@ -1,10 +1,9 @@
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers, exceptions
-from django.contrib.auth import get_user_model
 
-from chit_chat.models import Room, Message
-
-
-User = get_user_model()
+from chit_chat.models import RoomMembership, Message
+from chit_chat.presence import PRESENCE_STATUSES
 
 
 class ContentSerializer(serializers.Serializer):
@@ -20,21 +19,71 @@ class ContentSerializer(serializers.Serializer):
         return message_type
 
 
+class ChatUserDefault:
+    """The authenticated user sending the message, passed in as `context['user']`."""
+    requires_context = True
+
+    def __call__(self, serializer_field):
+        return serializer_field.context['user']
+
+
 class ChatMessageSerializer(serializers.Serializer):
-    room = serializers.PrimaryKeyRelatedField(queryset=Room.objects.all())
+    """Validates and saves an incoming chat message without any lookups: the sender is the
+    already authenticated `context['user']` and, when the caller knows which rooms the user
+    is in, membership is checked against `context['room_pks']`."""
+    room = serializers.IntegerField(source='room_id')
     text = serializers.CharField()
-    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    user = serializers.HiddenField(default=ChatUserDefault())
 
     def validate(self, attrs):
         # Make sure the user is in the room.
-        if not attrs['room'].members.filter(pk=attrs['user'].pk).exists():
+        room_pks = self.context.get('room_pks')
+        if room_pks is not None:
+            is_member = attrs['room_id'] in room_pks
+        else:
+            is_member = RoomMembership.objects.filter(room_id=attrs['room_id'], user=attrs['user']).exists()
+        if not is_member:
             raise exceptions.ValidationError('Cannot send messages to chat rooms that you are not a member of.')
         return attrs
 
     def create(self, validated_data):
-        message = Message.objects.create(**validated_data)
+        with transaction.atomic():
+            message = Message.objects.create(**validated_data)
 
-        # Add sender as viewer
-        message.users_who_viewed.add(message.user)
+            # Bump the room to the top of everyone's inbox, sender has seen it, everyone else
+            # gets it added to their unread count
+            message.update_room_state()
 
         return message
+
+
+class RoomEventSerializer(serializers.Serializer):
+    """Base for websocket messages about one of the sender's rooms, membership is checked
+    against `context['room_pks']`."""
+    room = serializers.IntegerField()
+
+    def validate_room(self, room):
+        if room not in self.context['room_pks']:
+            raise exceptions.ValidationError('Cannot send messages to chat rooms that you are not a member of.')
+        return room
+
+
+class TypingSerializer(RoomEventSerializer):
+    """Ephemeral "user is (no longer) typing in this room" notice, never saved."""
+    is_typing = serializers.BooleanField(default=True)
+
+
+class ReadSerializer(RoomEventSerializer):
+    """Read receipt, the sender has seen everything in the room sent up to `time` (defaults to
+    now, later times are capped to it)."""
+    time = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        now = timezone.now()
+        attrs['time'] = min(attrs.get('time', now), now)
+        return attrs
+
+
+class PresenceSerializer(serializers.Serializer):
+    """Ephemeral status update, fanned out to every room of the user and never saved."""
+    status = serializers.ChoiceField(choices=PRESENCE_STATUSES)
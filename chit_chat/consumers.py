@@ -1,13 +1,31 @@
-import json
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
 
+from asgiref.sync import sync_to_async
 from rest_framework import exceptions
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
-from chit_chat.consumer_serializers import ContentSerializer
+from chit_chat import metrics
+from chit_chat.cache import membership_cache
+from chit_chat.codecs import encode_event, ensure_encoded, get_json_codec, msgpack_codec
+from chit_chat.consumer_serializers import ContentSerializer, PresenceSerializer, ReadSerializer, TypingSerializer
+from chit_chat.models import Message
+from chit_chat.notifications import notification_dispatcher
+from chit_chat.presence import set_online, set_presence, socket_closed, socket_heartbeat, socket_opened
+from chit_chat.receipts import read_receipt_writer
+from chit_chat.relay import room_relay
+from chit_chat.replay import get_missed_messages, replay_buffer
+from chit_chat.throttling import TokenBuckets, room_buckets, take_tokens, user_buckets
+from chit_chat.writer import message_writer
 from .ckc_conf import chat_settings
 
 
+logger = logging.getLogger(__name__)
+
+
 def async_validation_exception_handler(func):
     async def inner(*args, **kwargs):
         self = args[0]
@@ -18,9 +36,9 @@ def async_validation_exception_handler(func):
             errors = e.detail
             if 'non_field_errors' not in errors:
                 errors = {'field_errors': errors}
-            await self.send(text_data=json.dumps(errors))
+            await self.send_data(errors)
         except Exception as e:  # pragma: no cover
-            await self.send(text_data=json.dumps({'non_field_errors': ['System Error']}))
+            await self.send_data({'non_field_errors': ['System Error']})
             raise e
     return inner
 
@@ -28,34 +46,100 @@ def async_validation_exception_handler(func):
 class ChatRoomConsumer(AsyncWebsocketConsumer):
     MESSAGE_TYPES = [
         'chat',
+        # Ephemeral, fanned out without touching the database
+        'typing',
+        'presence',
+        # Saved in batches, see `chit_chat.receipts`
+        'read',
     ]
 
+    # Clients asking for this subprotocol talk MessagePack binary frames with short keys
+    # (see `chit_chat.codecs.SHORT_KEYS`) both ways, everyone else gets JSON text frames.
+    MSGPACK_SUBPROTOCOL = 'chit-chat.msgpack'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Rooms this socket is in, and those of them it gets events for through `room_relay`
+        # rather than its own group membership
+        self.room_pks = set()
+        self.relayed_room_pks = set()
+        self.binary = False
+        # Last typing state sent per room and last presence sent, as (value, monotonic time)
+        self.typing_sent = {}
+        self.presence_sent = None
+        # Sends the latest presence received while broadcasting it had to wait
+        self.presence_task = None
+        self.socket_buckets = TokenBuckets('SOCKET', max_size=1)
+        # Ids of the messages sent on connect, they may still come in from the room groups
+        self.replayed_ids = set()
+        # Whether this socket is in its user's open socket count yet
+        self.counted = False
+
     async def connect(self):
         user = self.scope['user']
         if not user.is_authenticated:
             await self.close()
             return
 
-        await self.enter_rooms()
+        started = time.perf_counter()
+        await self.enter_rooms(relay=False)
 
         # Allows us to easily send targeted messages to this user throughout the app.
         await self.channel_layer.group_add(f'user-{user.pk}', self.channel_name)
-        await self.accept()
+
+        subprotocol = None
+        if msgpack_codec is not None and self.MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            subprotocol = self.MSGPACK_SUBPROTOCOL
+            self.binary = True
+        await self.accept(subprotocol=subprotocol)
+        metrics.connect_seconds.observe(time.perf_counter() - started, metrics.room_count_label(len(self.room_pks)))
+
+        # Relayed events come through our channel too, so they wait until we're done connecting
+        # and the ones that are also replayed are recognized as such
+        await room_relay.subscribe(self, self.relayed_room_pks)
+
+        # Rooms were joined before looking for missed messages, so nothing falls in between
+        last_seen = self.get_last_seen()
+        if last_seen:
+            await self.replay(last_seen)
+
+        # Only recorded, fanning presence out is left to clients that send it themselves. Kept
+        # from expiring for as long as the socket is open.
+        await sync_to_async(socket_opened)(user.pk)
+        self.counted = True
+        await sync_to_async(set_online)(user.pk)
+        socket_heartbeat.add(user.pk)
 
     async def disconnect(self, close_code):
         user = self.scope['user']
         if user.is_authenticated:
+            # Nobody should be left looking at a typing indicator for a closed socket
+            for room_pk, (is_typing, _) in list(self.typing_sent.items()):
+                if is_typing:
+                    await self.update_typing(room_pk, False)
+            if self.presence_task is not None:
+                self.presence_task.cancel()
+            if self.counted:
+                socket_heartbeat.discard(user.pk)
+                # Still online on their other sockets, wherever those are
+                if not await sync_to_async(socket_closed)(user.pk):
+                    if self.presence_sent is not None:
+                        await self.send_presence('offline')
+                    else:
+                        await sync_to_async(set_presence)(user.pk, 'offline')
             await self.exit_rooms()
             await self.channel_layer.group_discard(f'user-{user.pk}', self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
-        user = self.scope['user']
-        if bytes_data is not None:
-            text_data = bytes_data.decode()
+        # Throttled before even decoding the frame
+        if not await self.take_tokens(socket=self.socket_buckets.get(None), user=user_buckets.get(self.scope['user'].pk)):
+            return
+
+        codec = msgpack_codec if self.binary and bytes_data is not None else get_json_codec()
         try:
-            data = json.loads(text_data)
-        except json.decoder.JSONDecodeError:
-            await self.send(text_data=json.dumps({'non_field_errors': ['Invalid JSON.']}))
+            data = codec.loads(text_data if bytes_data is None else bytes_data)
+        except ValueError:
+            await self.send_data({'non_field_errors': [codec.invalid_message]})
             return
 
         valid = await self.validate_content(data)
@@ -63,30 +147,216 @@ class ChatRoomConsumer(AsyncWebsocketConsumer):
             message_type = data.get('message_type')
 
             if message_type == 'chat':
-                data['user'] = user.pk
-
-                if message := await self.validate_chat_message(data):
-                    await self.channel_layer.group_send(
-                        str(message.room.pk),
-                        {
-                            'type': 'chat',
-                            'user': user.pk,
-                            'room': message.room.pk,
-                            'text': message.text,
-                            'time': message.created_when.isoformat(),
-                            'id': message.id,
-                            # Attach the user who sent it as someone who has already viewed it
-                            'users_who_viewed': [user.pk],
-                        }
-                    )
-
-    async def enter_rooms(self):
-        for pk in await self.get_chat_room_pks(self.scope['user']):
-            await self.channel_layer.group_add(str(pk), self.channel_name)
-
-    async def exit_rooms(self):
-        for pk in await self.get_chat_room_pks(self.scope['user']):
-            await self.channel_layer.group_discard(str(pk), self.channel_name)
+                # The serializer takes the room as a number or a numeric string, so does the limit
+                try:
+                    room_pk = int(data.get('room'))
+                except (TypeError, ValueError):
+                    room_pk = None
+                if room_pk in self.room_pks:
+                    if not await self.take_tokens(room=room_buckets.get(room_pk)):
+                        return
+
+                # Checked against the membership cache rather than `room_pks`, signals clear
+                # it as soon as the user is removed from a room
+                room_pks = (await self.get_chat_rooms(self.scope['user'])).keys()
+                if chat_settings['WRITE_BEHIND']['ENABLED']:
+                    message = await self.queue_chat_message(data, room_pks)
+                else:
+                    message = await self.validate_chat_message(data, room_pks)
+                    if message:
+                        # Already saved, queued messages are handed over by the writer instead
+                        notification_dispatcher.put([message])
+
+                if message:
+                    await self.channel_layer.group_send(str(message.room_id), self.get_chat_event(message))
+            elif message_type == 'typing':
+                typing = await self.validate_typing(data)
+                if typing:
+                    await self.update_typing(typing['room'], typing['is_typing'])
+            elif message_type == 'presence':
+                presence = await self.validate_presence(data)
+                if presence:
+                    await self.update_presence(presence['status'])
+            elif message_type == 'read':
+                receipt = await self.validate_read(data)
+                if receipt:
+                    read_receipt_writer.put(receipt['room'], self.scope['user'].pk, receipt['time'])
+
+    async def take_tokens(self, **buckets):
+        limited = take_tokens(buckets.items())
+        if limited is None:
+            return True
+
+        scope, retry_after = limited
+        metrics.rate_limited.inc(scope)
+        await self.send_data({
+            'non_field_errors': [f'Too many messages, try again in {retry_after:.1f} seconds.'],
+            'retry_after': retry_after,
+        })
+        return False
+
+    def get_chat_event(self, message):
+        return self.get_event(self.get_chat_payload(message))
+
+    def get_event(self, payload):
+        return encode_event(payload)
+
+    def get_chat_payload(self, message):
+        return {
+            'type': 'chat',
+            'user': message.user_id,
+            'room': message.room_id,
+            'text': message.text,
+            'time': message.created_when.isoformat(),
+            # Not known yet for messages waiting to be written, uuid always is
+            'id': message.id,
+            'uuid': str(message.uuid),
+            # Attach the user who sent it as someone who has already viewed it
+            'users_who_viewed': [message.user_id],
+        }
+
+    def get_last_seen(self):
+        """{room pk: message id} from the `last_seen` query parameter, for rooms this socket
+        is in. Malformed pairs are ignored."""
+        last_seen = {}
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        for pair in ','.join(query.get('last_seen', [])).split(','):
+            room_pk, _, message_id = pair.partition(':')
+            if room_pk.isdigit() and message_id.isdigit() and int(room_pk) in self.room_pks:
+                last_seen[int(room_pk)] = int(message_id)
+        return last_seen
+
+    async def replay(self, last_seen):
+        missed = {}
+        for room_pk, message_id in last_seen.items():
+            events = replay_buffer.get_since(room_pk, message_id)
+            if events is None:
+                missed[room_pk] = message_id
+                continue
+            for event in events:
+                self.replayed_ids.add(event['id'])
+                await self.send_event(event)
+
+        if not missed:
+            return
+        messages, resync_room_pks = await database_sync_to_async(get_missed_messages)(
+            missed, chat_settings['REPLAY']['MAX_MESSAGES'],
+        )
+        for message in messages:
+            self.replayed_ids.add(message.id)
+            await self.send_data(self.get_chat_payload(message))
+        for room_pk in resync_room_pks:
+            await self.send_data({'type': 'resync', 'room': room_pk})
+
+    async def send_data(self, data):
+        if self.binary:
+            await self.send(bytes_data=msgpack_codec.dumps(data))
+        else:
+            await self.send(text_data=get_json_codec().dumps(data))
+
+    async def enter_rooms(self, rooms=None, relay=True):
+        """Joins the given `{room pk: member count}` (or all of the user's rooms), large ones
+        through the process wide relay and the others by joining their groups. Without
+        `relay` large rooms are only recorded, for `connect` to subscribe to once accepted."""
+        if rooms is None:
+            rooms = await self.get_chat_rooms(self.scope['user'])
+        threshold = chat_settings['LARGE_ROOM_MEMBERS']
+        new_rooms = {pk: count for pk, count in rooms.items() if pk not in self.room_pks}
+        relayed_room_pks = {
+            pk for pk, count in new_rooms.items()
+            if threshold is not None and count >= threshold
+        }
+
+        await self.update_groups('group_add', new_rooms.keys() - relayed_room_pks)
+        if relay:
+            await room_relay.subscribe(self, relayed_room_pks)
+        replay_buffer.subscribe(new_rooms)
+        self.room_pks |= new_rooms.keys()
+        self.relayed_room_pks |= relayed_room_pks
+
+    async def exit_rooms(self, room_pks=None):
+        """Leaves the given rooms, or all of them."""
+        room_pks = set(self.room_pks if room_pks is None else self.room_pks.intersection(room_pks))
+        relayed_room_pks = room_pks & self.relayed_room_pks
+
+        await self.update_groups('group_discard', room_pks - relayed_room_pks)
+        await room_relay.unsubscribe(self, relayed_room_pks)
+        replay_buffer.unsubscribe(room_pks)
+        self.room_pks -= room_pks
+        self.relayed_room_pks -= relayed_room_pks
+
+    async def update_typing(self, room_pk, is_typing):
+        # Coalesced per room: state changes go out right away, repeats once per INTERVAL
+        now = time.monotonic()
+        last = self.typing_sent.get(room_pk)
+        if last is not None and last[0] == is_typing and now - last[1] < chat_settings['TYPING']['INTERVAL']:
+            return
+        self.typing_sent[room_pk] = (is_typing, now)
+
+        await self.channel_layer.group_send(str(room_pk), self.get_event({
+            'type': 'typing',
+            'user': self.scope['user'].pk,
+            'room': room_pk,
+            'is_typing': is_typing,
+        }))
+
+    async def update_presence(self, status):
+        # Goes to every room, so broadcast at most once per INTERVAL whatever the status. Of
+        # what's received in between only the latest is sent, once the interval is over.
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+            self.presence_task = None
+        last = self.presence_sent
+        wait = 0 if last is None else last[1] + chat_settings['PRESENCE']['INTERVAL'] - time.monotonic()
+        if wait <= 0:
+            await self.send_presence(status)
+        elif status != last[0]:
+            self.presence_task = asyncio.ensure_future(self.send_presence_later(status, wait))
+
+    async def send_presence_later(self, status, delay):
+        await asyncio.sleep(delay)
+        self.presence_task = None
+        try:
+            await self.send_presence(status)
+        except Exception:
+            logger.exception('Failed to send presence of user %s', self.scope['user'].pk)
+
+    async def send_presence(self, status):
+        # Each broadcast also refreshes the stored TTL
+        self.presence_sent = (status, time.monotonic())
+        user_pk = self.scope['user'].pk
+        presence = await sync_to_async(set_presence)(user_pk, status)
+        await self.send_to_rooms(self.get_event({'type': 'presence', 'user': user_pk, **presence}))
+
+    async def send_to_rooms(self, event):
+        semaphore = asyncio.Semaphore(chat_settings['GROUP_CONCURRENCY'])
+
+        async def send(room_pk):
+            async with semaphore:
+                # Relays route on the room
+                await self.channel_layer.group_send(str(room_pk), {**event, 'room': room_pk})
+
+        await asyncio.gather(*(send(room_pk) for room_pk in self.room_pks))
+
+    async def update_groups(self, method, room_pks):
+        """Calls `group_add` or `group_discard` for every room concurrently instead of paying a
+        channel layer round trip per room, one after the other."""
+        groups = [str(pk) for pk in room_pks]
+        if not groups:
+            return
+
+        # Layers that can (un)subscribe from many groups at once get a single call
+        if hasattr(self.channel_layer, f'{method}_many'):
+            await getattr(self.channel_layer, f'{method}_many')(groups, self.channel_name)
+            return
+
+        semaphore = asyncio.Semaphore(chat_settings['GROUP_CONCURRENCY'])
+
+        async def update_group(group):
+            async with semaphore:
+                await getattr(self.channel_layer, method)(group, self.channel_name)
+
+        await asyncio.gather(*(update_group(group) for group in groups))
 
     @async_validation_exception_handler
     async def validate_content(self, data):
@@ -95,27 +365,90 @@ class ChatRoomConsumer(AsyncWebsocketConsumer):
 
     @async_validation_exception_handler
     @database_sync_to_async
-    def validate_chat_message(self, data):
-        serializer = chat_settings['SERIALIZERS'].MESSAGE(data=data)
+    def validate_chat_message(self, data, room_pks):
+        # Sender and membership come from this connection, the only queries left are the writes
+        serializer = chat_settings['SERIALIZERS'].MESSAGE(data=data, context={
+            'user': self.scope['user'],
+            'room_pks': room_pks,
+        })
         serializer.is_valid(raise_exception=True)
         return serializer.save()
 
+    @async_validation_exception_handler
+    async def validate_typing(self, data):
+        serializer = TypingSerializer(data=data, context={'room_pks': self.room_pks})
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @async_validation_exception_handler
+    async def validate_read(self, data):
+        serializer = ReadSerializer(data=data, context={'room_pks': self.room_pks})
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @async_validation_exception_handler
+    async def validate_presence(self, data):
+        serializer = PresenceSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @async_validation_exception_handler
+    async def queue_chat_message(self, data, room_pks):
+        # Validation doesn't need the database (see `validate_chat_message`), only the write
+        # does and that's left to the background writer.
+        serializer = chat_settings['SERIALIZERS'].MESSAGE(data=data, context={
+            'user': self.scope['user'],
+            'room_pks': room_pks,
+        })
+        serializer.is_valid(raise_exception=True)
+        message = Message(**serializer.validated_data)
+        await message_writer.put(message)
+        return message
+
+    async def send_event(self, event):
+        event = ensure_encoded(event)
+        if self.binary:
+            await self.send(bytes_data=event['bytes_data'])
+        else:
+            await self.send(text_data=event['text_data'])
+
     async def chat(self, event):
-        await self.send(
-            text_data=json.dumps({
-                'type': 'chat',
-                'user': event.get('user'),
-                'text': event.get('text'),
-                'room': event.get('room'),
-                'time': event.get('time'),
-                'id': event.get('id'),
-                'users_who_viewed': event.get('users_who_viewed'),
-            })
-        )
+        event = ensure_encoded(event)
+        replay_buffer.append(event)
+        if event['id'] not in self.replayed_ids:
+            await self.send_event(event)
+
+    async def typing(self, event):
+        # Senders know what they're doing, no need to echo it back
+        if event['user'] != self.scope['user'].pk:
+            await self.send_event(event)
+
+    presence = typing
+
+    async def read(self, event):
+        # Also goes to the reader's other sockets, so they can clear their unread badges
+        await self.send_event(event)
+
+    async def refresh_group_add(self, event):
+        # Our cached rooms may be missing the new ones if they were added from another process
+        membership_cache.invalidate(self.scope['user'].pk)
+        rooms = event.get('rooms')
+        # New rooms join through their groups, they're relayed from the next connect on if
+        # they're already large
+        await self.enter_rooms(None if rooms is None else dict.fromkeys(rooms, 0))
+
+    async def refresh_group_discard(self, event):
+        # Removed from these rooms, maybe from another process
+        membership_cache.invalidate(self.scope['user'].pk)
+        await self.exit_rooms(event['rooms'])
 
-    async def refresh_group_add(self, _):
-        await self.enter_rooms()
+    async def get_chat_rooms(self, user):
+        rooms = membership_cache.get(user.pk)
+        if rooms is None:
+            rooms = await self.fetch_chat_rooms(user)
+            membership_cache.set(user.pk, rooms)
+        return rooms
 
     @database_sync_to_async
-    def get_chat_room_pks(self, user):
-        return list(user.chat_rooms.values_list('pk', flat=True))
+    def fetch_chat_rooms(self, user):
+        return dict(user.chat_rooms.values_list('pk', 'member_count'))
@@ -0,0 +1,220 @@
+import asyncio
+import random
+import string
+import time
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class _ChannelQueue(asyncio.Queue):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Senders waiting for room under the "block" policy, the queue must outlive them
+        self.blocked = 0
+
+
+class _Shard:
+    def __init__(self):
+        # channel name -> _ChannelQueue of (expires, message)
+        self.channels = {}
+        # group name -> {channel name: joined at}
+        self.groups = {}
+        # channel name -> names of the groups it's in, so dropping a channel is O(its groups)
+        self.channel_groups = {}
+
+
+class ShardedInMemoryChannelLayer(BaseChannelLayer):
+    """Single process channel layer for chat fan-out, a drop-in replacement for
+    `channels.layers.InMemoryChannelLayer`.
+
+    The stock layer sweeps every channel and group membership on each send and receive and
+    deep copies a group message once per member. Here channels and groups are spread over
+    `shards`, expiry sweeps one shard at a time every `sweep_interval` seconds, and a group
+    message is copied once for all its members, which must treat it as read-only.
+
+    `full_policy` decides what happens when a channel already holds `capacity` messages:
+    "raise" raises ChannelFull (group sends skip that channel, like the stock layer),
+    "drop_oldest" makes room by dropping the channel's oldest message and "block" waits up
+    to `expiry` seconds for room, slowing the sender down to the pace of its receivers."""
+
+    extensions = ['groups', 'flush']
+
+    FULL_POLICIES = ('raise', 'drop_oldest', 'block')
+
+    def __init__(
+        self,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        shards=16,
+        full_policy='raise',
+        sweep_interval=1,
+        **kwargs
+    ):
+        assert full_policy in self.FULL_POLICIES, f'full_policy must be one of {self.FULL_POLICIES}'
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        self.full_policy = full_policy
+        self.sweep_interval = sweep_interval
+        self.shards = [_Shard() for _ in range(shards)]
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._sweep_index = 0
+
+    def _shard(self, name):
+        return self.shards[hash(name) % len(self.shards)]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        self._maybe_sweep()
+        await self._put(channel, deepcopy(message))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        self._maybe_sweep()
+        channels = self._shard(channel).channels
+        queue = self._get_queue(channel)
+
+        while True:
+            expires, message = await queue.get()
+            if expires >= time.time():
+                break
+
+        if queue.empty() and not queue.blocked and channels.get(channel) is queue:
+            del channels[channel]
+        return message
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.inmemory!%s' % (
+            prefix,
+            ''.join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    async def flush(self):
+        self.shards = [_Shard() for _ in self.shards]
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self._group_add(group, channel, time.time())
+
+    async def group_add_many(self, groups, channel):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        joined = time.time()
+        for group in groups:
+            assert self.valid_group_name(group), 'Group name not valid'
+            self._group_add(group, channel, joined)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self._group_discard(group, channel)
+
+    async def group_discard_many(self, groups, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        for group in groups:
+            assert self.valid_group_name(group), 'Invalid group name'
+            self._group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self._maybe_sweep()
+
+        channels = list(self._shard(group).groups.get(group, ()))
+        if not channels:
+            return
+        # One copy shared by every member, each only gets its own top level dict
+        message = deepcopy(message)
+        for channel in channels:
+            try:
+                await self._put(channel, dict(message))
+            except ChannelFull:
+                pass
+
+    # Internals
+
+    def _get_queue(self, channel):
+        channels = self._shard(channel).channels
+        queue = channels.get(channel)
+        if queue is None:
+            queue = channels[channel] = _ChannelQueue(maxsize=self.get_capacity(channel))
+        return queue
+
+    async def _put(self, channel, message):
+        queue = self._get_queue(channel)
+        item = (time.time() + self.expiry, message)
+        if not queue.full():
+            queue.put_nowait(item)
+        elif self.full_policy == 'drop_oldest':
+            queue.get_nowait()
+            queue.put_nowait(item)
+        elif self.full_policy == 'block':
+            queue.blocked += 1
+            try:
+                await asyncio.wait_for(queue.put(item), self.expiry)
+            except asyncio.TimeoutError:
+                raise ChannelFull(channel)
+            finally:
+                queue.blocked -= 1
+        else:
+            raise ChannelFull(channel)
+
+    def _group_add(self, group, channel, joined):
+        self._shard(group).groups.setdefault(group, {})[channel] = joined
+        self._shard(channel).channel_groups.setdefault(channel, set()).add(group)
+
+    def _group_discard(self, group, channel):
+        groups = self._shard(group).groups
+        members = groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del groups[group]
+
+        channel_groups = self._shard(channel).channel_groups
+        joined = channel_groups.get(channel)
+        if joined is not None:
+            joined.discard(group)
+            if not joined:
+                del channel_groups[channel]
+
+    def _remove_channel(self, channel):
+        shard = self._shard(channel)
+        shard.channels.pop(channel, None)
+        for group in shard.channel_groups.get(channel, set()).copy():
+            self._group_discard(group, channel)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        self._sweep(self.shards[self._sweep_index])
+        self._sweep_index = (self._sweep_index + 1) % len(self.shards)
+
+    def _sweep(self, shard):
+        """Drops the shard's channels nobody received from in time and its group memberships
+        older than `group_expiry`."""
+        now = time.time()
+        for channel, queue in list(shard.channels.items()):
+            # Oldest message is first in line, if it expired the receiver is gone
+            if not queue.empty() and queue._queue[0][0] < now:
+                self._remove_channel(channel)
+
+        joined_before = now - self.group_expiry
+        for group, members in list(shard.groups.items()):
+            for channel, joined in list(members.items()):
+                if joined < joined_before:
+                    self._group_discard(group, channel)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.retention import get_archive_storage, prune_messages
+
+
+class Command(BaseCommand):
+    help = "Deletes (or archives) messages past their room's retention, see the RETENTION setting."
+
+    def add_arguments(self, parser):
+        retention = chat_settings['RETENTION']
+        parser.add_argument('--archive', action='store_true', help='Move messages to RETENTION["ARCHIVE_DIR"] instead of deleting them.')
+        parser.add_argument('--batch-size', type=int, default=retention['BATCH_SIZE'], help='Messages removed per transaction.')
+        parser.add_argument('--sleep', type=float, default=retention['SLEEP'], help='Seconds to wait between batches.')
+        parser.add_argument('--room', type=int, action='append', dest='room_pks', help='Only this room, can be repeated.')
+
+    def handle(self, *args, archive, batch_size, sleep, room_pks, **options):
+        if archive and get_archive_storage() is None:
+            raise CommandError('--archive needs RETENTION["ARCHIVE_DIR"] to be set.')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        total = 0
+        for room, removed in prune_messages(batch_size, sleep, archive, room_pks):
+            if removed:
+                self.stdout.write(f'Room {room.pk}: {"archived" if archive else "deleted"} {removed} messages')
+            total += removed
+        self.stdout.write(self.style.SUCCESS(f'{"Archived" if archive else "Deleted"} {total} messages'))
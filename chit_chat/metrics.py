@@ -0,0 +1,73 @@
+import logging
+import threading
+from collections import defaultdict, deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._values = defaultdict(int)
+
+    def inc(self, label='', amount=1):
+        with self._lock:
+            self._values[label] += amount
+        logger.debug('%s{%s} += %s', self.name, label, amount)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    """Keeps the latest `size` observations per label, enough to read off percentiles."""
+
+    def __init__(self, name, size=1000):
+        self.name = name
+        self._lock = threading.Lock()
+        self._observations = defaultdict(lambda: deque(maxlen=size))
+
+    def observe(self, value, label=''):
+        with self._lock:
+            self._observations[label].append(value)
+        logger.debug('%s{%s} %s', self.name, label, value)
+
+    def percentile(self, percentile, label=''):
+        with self._lock:
+            observations = sorted(self._observations.get(label, ()))
+        if not observations:
+            return None
+        return observations[min(len(observations) - 1, int(len(observations) * percentile / 100))]
+
+    def snapshot(self):
+        with self._lock:
+            labels = list(self._observations)
+        return {
+            label: {'count': len(self._observations[label]), 'p50': self.percentile(50, label), 'p99': self.percentile(99, label)}
+            for label in labels
+        }
+
+
+def room_count_label(room_count):
+    """Buckets a user's room count so latencies can be compared across membership sizes."""
+    for bound in (10, 100, 1000):
+        if room_count <= bound:
+            return f'<={bound}'
+    return '>1000'
+
+
+# Seconds from websocket connect to accept, labelled with the user's room count bucket
+connect_seconds = Histogram('chit_chat_connect_seconds')
+
+# Incoming frames dropped by RATE_LIMITS, labelled with the scope that ran out of tokens
+rate_limited = Counter('chit_chat_rate_limited')
+
+
+def snapshot():
+    return {
+        metric.name: metric.snapshot()
+        for metric in (connect_seconds, rate_limited)
+    }
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0004_auto_20220331_2234'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created_when', 'id'], name='chit_chat_m_room_id_49c90c_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0005_message_room_created_when_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommembership',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='roommembership',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:47
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+BATCH_SIZE = 1000
+
+
+def copy_viewed_messages_to_read_state(apps, schema_editor):
+    RoomMembership = apps.get_model('chit_chat', 'RoomMembership')
+    Message = apps.get_model('chit_chat', 'Message')
+    MessageViewed = Message._meta.get_field('users_who_viewed').remote_field.through
+
+    # Latest message each member has viewed in the room becomes their read watermark
+    last_viewed = MessageViewed.objects.filter(
+        user_id=OuterRef('user_id'),
+        message__room_id=OuterRef('room_id'),
+    ).order_by('-message__created_when').values('message__created_when')[:1]
+
+    # Walk memberships by pk in batches, committing each one (see `atomic` below) so we never
+    # hold a long running transaction over the viewed messages table.
+    last_pk = 0
+    while True:
+        memberships = list(
+            RoomMembership.objects.filter(pk__gt=last_pk).order_by('pk').annotate(viewed_until=Subquery(last_viewed))[:BATCH_SIZE]
+        )
+        if not memberships:
+            break
+        last_pk = memberships[-1].pk
+
+        for membership in memberships:
+            unread = Message.objects.filter(room_id=membership.room_id).exclude(user_id=membership.user_id)
+            if membership.viewed_until is not None:
+                unread = unread.filter(created_when__gt=membership.viewed_until)
+            membership.last_read_at = membership.viewed_until
+            membership.unread_count = unread.count()
+        RoomMembership.objects.bulk_update(memberships, ['last_read_at', 'unread_count'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chit_chat', '0006_roommembership_read_state'),
+    ]
+
+    operations = [
+        # Going backwards leaves the re-created users_who_viewed table empty, watermarks can't
+        # be expanded back into one row per message without recreating the original problem.
+        migrations.RunPython(copy_viewed_messages_to_read_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:47
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0007_copy_viewed_messages_to_read_state'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='users_who_viewed',
+        ),
+    ]
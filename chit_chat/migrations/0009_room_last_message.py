@@ -0,0 +1,34 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0008_remove_message_users_who_viewed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chit_chat.message'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='roommembership',
+            name='last_message_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='roommembership',
+            index=models.Index(fields=['user', '-last_message_at'], name='chit_chat_r_user_id_ea9718_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:49
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_last_message(apps, schema_editor):
+    Room = apps.get_model('chit_chat', 'Room')
+    RoomMembership = apps.get_model('chit_chat', 'RoomMembership')
+    Message = apps.get_model('chit_chat', 'Message')
+
+    latest = Message.objects.filter(room_id=OuterRef('pk')).order_by('-created_when', '-id')
+
+    # Batches of rooms committed one at a time, see `atomic` below
+    last_pk = 0
+    while True:
+        rooms = list(
+            Room.objects.filter(pk__gt=last_pk).order_by('pk').annotate(
+                latest_message_id=Subquery(latest.values('id')[:1]),
+                latest_message_at=Subquery(latest.values('created_when')[:1]),
+            )[:BATCH_SIZE]
+        )
+        if not rooms:
+            break
+        last_pk = rooms[-1].pk
+
+        for room in rooms:
+            room.last_message_id = room.latest_message_id
+            room.last_message_at = room.latest_message_at
+        Room.objects.bulk_update(rooms, ['last_message', 'last_message_at'])
+
+        RoomMembership.objects.filter(room_id__in=[room.pk for room in rooms]).update(
+            last_message_at=Coalesce(
+                Subquery(Room.objects.filter(pk=OuterRef('room_id')).values('last_message_at')),
+                'created_when',
+            ),
+        )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chit_chat', '0009_room_last_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0010_backfill_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='member_signature',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:50
+
+import hashlib
+from collections import defaultdict
+
+from django.db import migrations
+
+
+BATCH_SIZE = 1000
+
+
+def get_member_signature(member_pks):
+    # Copy of Room.get_member_signature, historical models don't carry model methods
+    return hashlib.sha256(','.join(str(pk) for pk in sorted(set(member_pks))).encode()).hexdigest()
+
+
+def backfill_member_signature(apps, schema_editor):
+    Room = apps.get_model('chit_chat', 'Room')
+    RoomMembership = apps.get_model('chit_chat', 'RoomMembership')
+
+    # Rooms are walked oldest first, so when several rooms have the same members the original
+    # one keeps the signature (matching what room creation used to return).
+    last_pk = 0
+    while True:
+        rooms = list(Room.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not rooms:
+            break
+        last_pk = rooms[-1].pk
+
+        member_pks = defaultdict(list)
+        for room_id, user_id in RoomMembership.objects.filter(room_id__in=[room.pk for room in rooms]).values_list('room_id', 'user_id'):
+            member_pks[room_id].append(user_id)
+
+        signatures = {room.pk: get_member_signature(member_pks[room.pk]) for room in rooms if member_pks[room.pk]}
+        taken = set(Room.objects.filter(member_signature__in=signatures.values()).values_list('member_signature', flat=True))
+
+        signed = []
+        for room in rooms:
+            signature = signatures.get(room.pk)
+            if signature is None or signature in taken:
+                continue
+            taken.add(signature)
+            room.member_signature = signature
+            signed.append(room)
+        Room.objects.bulk_update(signed, ['member_signature'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chit_chat', '0011_room_member_signature'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_member_signature, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.12 on 2026-10-18 08:55
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0012_backfill_member_signature'),
+    ]
+
+    operations = [
+        # Added without a default first, otherwise every existing message would get the same
+        # (single evaluation of the callable) default and break the unique constraint.
+        migrations.AddField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, null=True, unique=True),
+        ),
+    ]
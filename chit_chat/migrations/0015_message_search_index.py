@@ -0,0 +1,79 @@
+# Generated by Django 3.2.12 on 2026-10-18 12:05
+
+from django.db import migrations, OperationalError
+
+
+# Triggers instead of signals, so bulk_create (see WRITE_BEHIND) and queryset deletes are indexed too
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE chit_chat_message_fts USING fts5(
+        text, content='chit_chat_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chit_chat_message_fts_insert AFTER INSERT ON chit_chat_message BEGIN
+        INSERT INTO chit_chat_message_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER chit_chat_message_fts_delete AFTER DELETE ON chit_chat_message BEGIN
+        INSERT INTO chit_chat_message_fts (chit_chat_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER chit_chat_message_fts_update AFTER UPDATE OF text ON chit_chat_message BEGIN
+        INSERT INTO chit_chat_message_fts (chit_chat_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO chit_chat_message_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    "INSERT INTO chit_chat_message_fts (chit_chat_message_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARDS = [
+    'DROP TRIGGER IF EXISTS chit_chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chit_chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chit_chat_message_fts_update',
+    'DROP TABLE IF EXISTS chit_chat_message_fts',
+]
+
+# Must match the expression `chit_chat.search` queries with for the index to be used
+POSTGRESQL_FORWARDS = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS chit_chat_message_text_search ON chit_chat_message "
+    "USING GIN (to_tsvector('simple', text))",
+]
+POSTGRESQL_BACKWARDS = [
+    'DROP INDEX CONCURRENTLY IF EXISTS chit_chat_message_text_search',
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_FORWARDS[0])
+        except OperationalError:
+            # SQLite built without FTS5, search falls back to scanning
+            return
+        for statement in SQLITE_FORWARDS[1:]:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        for statement in POSTGRESQL_FORWARDS:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    statements = {'sqlite': SQLITE_BACKWARDS, 'postgresql': POSTGRESQL_BACKWARDS}
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+    # Postgres can't build indexes concurrently inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('chit_chat', '0014_roomchange'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
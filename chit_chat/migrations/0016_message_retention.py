@@ -0,0 +1,38 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0015_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField()),
+                ('oldest_when', models.DateTimeField()),
+                ('oldest_id', models.PositiveIntegerField()),
+                ('newest_when', models.DateTimeField()),
+                ('newest_id', models.PositiveIntegerField()),
+                ('created_when', models.DateTimeField(default=django.utils.timezone.now)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_archives', to='chit_chat.room')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='messagearchive',
+            index=models.Index(fields=['room', 'newest_when', 'newest_id'], name='chit_chat_m_room_id_dafb46_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0016_message_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
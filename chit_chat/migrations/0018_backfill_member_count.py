@@ -0,0 +1,43 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:19
+
+from django.db import migrations
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_member_count(apps, schema_editor):
+    Room = apps.get_model('chit_chat', 'Room')
+    RoomMembership = apps.get_model('chit_chat', 'RoomMembership')
+
+    member_count = (
+        RoomMembership.objects.filter(room=OuterRef('pk'))
+        .order_by()
+        .values('room')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    # One UPDATE per range of rooms, so no single statement locks the whole table
+    last_pk = 0
+    while True:
+        pks = list(Room.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        Room.objects.filter(pk__gte=pks[0], pk__lte=last_pk).update(
+            member_count=Coalesce(Subquery(member_count, output_field=IntegerField()), 0),
+        )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chit_chat', '0017_room_member_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_member_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0018_backfill_member_count'),
+    ]
+
+    operations = [
+        # The new index is in place before the one it replaces goes
+        migrations.AddIndex(
+            model_name='roommembership',
+            index=models.Index(fields=['user', 'archived', '-last_message_at', '-room'], name='chit_chat_r_user_id_3fa0d9_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='roommembership',
+            name='chit_chat_r_user_id_ea9718_idx',
+        ),
+    ]
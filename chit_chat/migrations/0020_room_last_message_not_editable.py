@@ -0,0 +1,24 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chit_chat', '0019_roommembership_inbox_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chit_chat.message'),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
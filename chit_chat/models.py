@@ -1,6 +1,14 @@
+import hashlib
+import uuid
+
 from django.contrib.auth import get_user_model
 from django.utils import timezone
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from chit_chat.cache import room_list_cache
+from chit_chat.ckc_conf import chat_settings
 
 
 User = get_user_model()
@@ -10,6 +18,127 @@ class Room(models.Model):
     members = models.ManyToManyField(User, related_name='chat_rooms', through='RoomMembership')
     created_when = models.DateTimeField(default=timezone.now)
 
+    # Denormalized from the room's newest message so the inbox never aggregates messages
+    last_message = models.ForeignKey('Message', related_name='+', null=True, blank=True, on_delete=models.SET_NULL, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Hash of the sorted member ids, lets us find the room for an exact set of members with
+    # one unique index lookup. Only one room can own a given set of members, any other room
+    # that ends up with the same members (i.e. members added after creation) keeps None.
+    member_signature = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+
+    # Kept with the signature, rooms with LARGE_ROOM_MEMBERS or more are delivered to sockets
+    # through a single relay per process (see `chit_chat.relay`)
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Messages older than this many days are pruned (or archived, see `prune_messages`), None
+    # follows the RETENTION setting
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+
+    @staticmethod
+    def get_member_signature(member_pks):
+        return hashlib.sha256(','.join(str(pk) for pk in sorted(set(member_pks))).encode()).hexdigest()
+
+    def refresh_member_signature(self):
+        member_pks = list(self.memberships.values_list('user_id', flat=True))
+        signature = Room.get_member_signature(member_pks) if member_pks else None
+        try:
+            with transaction.atomic():
+                Room.objects.filter(pk=self.pk).update(member_signature=signature, member_count=len(member_pks))
+        except IntegrityError:
+            signature = None
+            Room.objects.filter(pk=self.pk).update(member_signature=signature, member_count=len(member_pks))
+        self.member_signature = signature
+        self.member_count = len(member_pks)
+
+
+class RoomMembershipQuerySet(models.QuerySet):
+    def record_messages(self, messages):
+        """Bumps the unread counter of every member of the room by the messages they didn't
+        send themselves. A member who sent one of the messages has read everything up to it, so
+        their read watermark moves up to their last message instead. One UPDATE regardless of
+        the room's history or of how many messages there are.
+
+        All messages must belong to the same room."""
+        messages = sorted(messages, key=lambda message: message.created_when)
+        newest = messages[-1].created_when
+
+        last_sent = {message.user_id: index for index, message in enumerate(messages)}
+        unread_since_sending, read_until = [], []
+        for user_id, index in last_sent.items():
+            unread = sum(1 for message in messages[index + 1:] if message.user_id != user_id)
+            unread_since_sending.append(When(user_id=user_id, then=Value(unread)))
+            read_until.append(When(user_id=user_id, then=Value(messages[index].created_when)))
+
+        return self.filter(room_id=messages[0].room_id).update(
+            last_message_at=Case(
+                When(last_message_at__gt=newest, then=F('last_message_at')),
+                default=Value(newest),
+                output_field=models.DateTimeField(),
+            ),
+            unread_count=Case(
+                *unread_since_sending,
+                default=F('unread_count') + len(messages),
+                output_field=models.PositiveIntegerField(),
+            ),
+            last_read_at=Case(
+                *read_until,
+                default=F('last_read_at'),
+                output_field=models.DateTimeField(),
+            ),
+        )
+
+    def record_reads(self, room_id, receipts):
+        """Moves the read watermarks of the room's members forward to the times given by
+        `receipts`, a `{user_id: read until}` dict, and recounts what's still unread after
+        them. One UPDATE for all the receipts, watermarks never move backwards."""
+        until = Case(
+            *[When(user_id=user_id, then=Value(read_until)) for user_id, read_until in receipts.items()],
+            output_field=models.DateTimeField(),
+        )
+        # Same, looked up from inside the unread messages subquery
+        reader_until = Case(
+            *[When(reader_id=user_id, then=Value(read_until)) for user_id, read_until in receipts.items()],
+            output_field=models.DateTimeField(),
+        )
+
+        # Messages from others after the receipt, only counted when it's older than the room's
+        # last message. Typed like the user pk, which needn't be an integer.
+        unread = Message.objects.annotate(
+            reader_id=ExpressionWrapper(OuterRef('user_id'), output_field=self.model._meta.get_field('user').target_field),
+        ).filter(
+            room_id=room_id,
+            created_when__gt=reader_until,
+        ).exclude(user_id=OuterRef('user_id')).order_by().values('room_id').annotate(count=Count('*')).values('count')
+
+        return self.filter(
+            Q(last_read_at__isnull=True) | Q(last_read_at__lt=until),
+            room_id=room_id,
+            user_id__in=receipts,
+        ).update(
+            last_read_at=until,
+            unread_count=Case(
+                When(last_message_at__lte=until, then=Value(0)),
+                default=Coalesce(Subquery(unread), 0),
+                output_field=models.PositiveIntegerField(),
+            ),
+        )
+
+    def mark_read(self, until=None):
+        return self.update(last_read_at=until or timezone.now(), unread_count=0)
+
+    def invalidate_room_lists(self, user_ids=()):
+        """Cached room lists of these memberships' users, and of `user_ids`, are rebuilt on their
+        next request. One query for the user ids."""
+        if not chat_settings['ROOM_LIST_CACHE']['ENABLED']:
+            return
+        user_ids = set(self.values_list('user_id', flat=True)).union(user_ids)
+        room_list_cache.invalidate(*user_ids)
+        # A request racing the current transaction could still cache what it's changing, under
+        # the new version, so that one is replaced again once the changes are visible
+        if transaction.get_connection(self.db).in_atomic_block:
+            transaction.on_commit(lambda: room_list_cache.invalidate(*user_ids), using=self.db)
+
 
 class RoomMembership(models.Model):
     room = models.ForeignKey(Room, related_name='memberships', on_delete=models.CASCADE)
@@ -18,13 +147,104 @@ class RoomMembership(models.Model):
     ignore_notifications = models.BooleanField(default=False)
     created_when = models.DateTimeField(default=timezone.now)
 
+    # Read state: everything in the room sent up to `last_read_at` has been seen by this member
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    # Copy of `Room.last_message_at` that the inbox sorts on, rooms without messages sort by
+    # when the member joined.
+    last_message_at = models.DateTimeField(default=timezone.now)
+
+    objects = RoomMembershipQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # The inbox, a user's archived or unarchived rooms newest first (see `RoomViewSet`)
+            models.Index(fields=['user', 'archived', '-last_message_at', '-room']),
+        ]
+
+
+class RoomChangeQuerySet(models.QuerySet):
+    def record(self, changes):
+        """Logs `(room_id, user_id)` pairs, one INSERT for all of them. Whatever changed shows
+        in the room lists of everyone in those rooms, and of the users if they just left."""
+        changes = self.bulk_create([RoomChange(room_id=room_id, user_id=user_id) for room_id, user_id in changes])
+        RoomMembership.objects.filter(room_id__in={change.room_id for change in changes}).invalidate_room_lists(
+            {change.user_id for change in changes}
+        )
+        return changes
+
+
+class RoomChange(models.Model):
+    """Changelog behind the sync endpoint, its ids are part of the sync token. A row is logged
+    whenever a member joins or leaves a room, or their read watermark or settings change.
+    New messages aren't logged, their own ids make up the rest of the token.
+
+    Neither foreign key is enforced, rows outlive deleted rooms and users so their former
+    members still learn about it."""
+    room = models.ForeignKey(Room, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    user = models.ForeignKey(User, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    created_when = models.DateTimeField(default=timezone.now)
+
+    objects = RoomChangeQuerySet.as_manager()
+
+
+class MessageQuerySet(models.QuerySet):
+    def update_room_state(self, messages):
+        """Denormalizes freshly saved messages onto their rooms and the rooms' memberships,
+        two UPDATEs per room."""
+        rooms = {}
+        for message in messages:
+            rooms.setdefault(message.room_id, []).append(message)
+
+        for room_id, room_messages in rooms.items():
+            newest = max(room_messages, key=lambda message: message.created_when)
+            Room.objects.filter(
+                Q(last_message_at__isnull=True) | Q(last_message_at__lte=newest.created_when),
+                pk=room_id,
+            ).update(last_message=newest, last_message_at=newest.created_when)
+            RoomMembership.objects.record_messages(room_messages)
+        RoomMembership.objects.filter(room_id__in=rooms).invalidate_room_lists()
+
 
 class Message(models.Model):
+    # Assigned when the message is created in memory, so it can be referred to before it is
+    # saved (see the WRITE_BEHIND setting). Messages from before this field existed have none.
+    uuid = models.UUIDField(default=uuid.uuid4, null=True, unique=True, editable=False)
     text = models.TextField()
     room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name='chat_room_messages', on_delete=models.CASCADE)
     created_when = models.DateTimeField(default=timezone.now)
-    users_who_viewed = models.ManyToManyField(User, related_name='chat_room_messages_viewed')
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a room's history and "latest N messages per room"
+            models.Index(fields=['room', 'created_when', 'id']),
+        ]
+
+    def update_room_state(self):
+        Message.objects.update_room_state([self])
 
     def __str__(self):
         return f"Sent by User.id = {self.user_id} @ {self.created_when:%I:%M%p}"
+
+
+class MessageArchive(models.Model):
+    """A batch of a room's messages moved out of the database into a gzipped JSONL file, by
+    `prune_messages --archive`. Read back when someone scrolls past the oldest message left."""
+    room = models.ForeignKey(Room, related_name='message_archives', on_delete=models.CASCADE)
+    path = models.CharField(max_length=255)
+    count = models.PositiveIntegerField()
+    # Position of the oldest and newest message in the file, in the room's (created_when, id) order
+    oldest_when = models.DateTimeField()
+    oldest_id = models.PositiveIntegerField()
+    newest_when = models.DateTimeField()
+    newest_id = models.PositiveIntegerField()
+    created_when = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'newest_when', 'newest_id']),
+        ]
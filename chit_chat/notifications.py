@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import Counter, deque
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.utils.module_loading import import_string
+
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.models import RoomMembership
+from chit_chat.presence import get_open_sockets
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseNotificationBackend:
+    """Delivers digests to members who weren't around to see the messages, i.e. as push
+    notifications or emails. Called from a worker thread, once per DIGEST_INTERVAL with
+    everything that's due.
+
+    Each digest is a dict with the `user` and `room` pks, how many messages were sent to the
+    room in that time (`count`, not counting the user's own) and the newest MAX_MESSAGES
+    of them as Message instances (`messages`, oldest first)."""
+
+    def send(self, digests):
+        raise NotImplementedError
+
+
+class LocMemBackend(BaseNotificationBackend):
+    """Keeps digests in `LocMemBackend.outbox` instead of sending them, for tests."""
+    outbox = []
+
+    def send(self, digests):
+        LocMemBackend.outbox.extend(digests)
+
+
+_backends = {}
+
+
+def get_notification_backend():
+    """Backend named by NOTIFICATIONS['BACKEND'], None when notifications are off."""
+    path = chat_settings['NOTIFICATIONS']['BACKEND']
+    if path is None:
+        return None
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+class _RoomMessages:
+    def __init__(self):
+        self.count = 0
+        self.counts_by_user = Counter()
+        self.newest = deque(maxlen=chat_settings['NOTIFICATIONS']['MAX_MESSAGES'])
+
+    def add(self, message):
+        self.count += 1
+        self.counts_by_user[message.user_id] += 1
+        self.newest.append(message)
+
+
+def get_digests(rooms):
+    """Digests for the members of the rooms (`{room pk: _RoomMessages}`) who should be told.
+
+    Muted and archived memberships are left out with the one query resolving members, then
+    anyone with a socket open, in any process, with one cache lookup. Whatever their client
+    last said their presence was, they've seen the messages arrive."""
+    memberships = list(
+        RoomMembership.objects
+        .filter(room_id__in=rooms, ignore_notifications=False, archived=False)
+        .values_list('room_id', 'user_id')
+    )
+    open_sockets = get_open_sockets({user_pk for _, user_pk in memberships})
+
+    digests = []
+    for room_pk, user_pk in memberships:
+        if open_sockets[user_pk]:
+            continue
+        room_messages = rooms[room_pk]
+        count = room_messages.count - room_messages.counts_by_user[user_pk]
+        if not count:
+            # They sent everything themselves
+            continue
+        digests.append({
+            'user': user_pk,
+            'room': room_pk,
+            'count': count,
+            'messages': [message for message in room_messages.newest if message.user_id != user_pk],
+        })
+    return digests
+
+
+class NotificationDispatcher:
+    """Tells offline members about saved chat messages, in digests.
+
+    The first message to a room starts a DIGEST_INTERVAL long wait, every message saved in
+    this process until then goes into the same round of digests, at most one per member
+    and room. Processes keep separate rounds, so with several of them a member can get one
+    digest per process. Rounds still waiting when a process exits are dropped."""
+
+    def __init__(self):
+        # {room pk: _RoomMessages}
+        self._pending = {}
+        self._loop = None
+        self._task = None
+
+    def put(self, messages):
+        """Called from the event loop with messages that have been saved."""
+        if get_notification_backend() is None:
+            return
+        for message in messages:
+            self._pending.setdefault(message.room_id, _RoomMessages()).add(message)
+        loop = asyncio.get_running_loop()
+        # Same as `ReadReceiptWriter.put`, one round at a time per event loop
+        if self._loop is not loop or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._dispatch_later())
+
+    async def drain(self):
+        """Waits until everything received so far has been handed to the backend."""
+        if self._loop is asyncio.get_running_loop():
+            await self._task
+
+    async def _dispatch_later(self):
+        while self._pending:
+            await asyncio.sleep(chat_settings['NOTIFICATIONS']['DIGEST_INTERVAL'])
+            rooms, self._pending = self._pending, {}
+            try:
+                digests = await database_sync_to_async(get_digests)(rooms)
+                if digests:
+                    await sync_to_async(get_notification_backend().send, thread_sensitive=False)(digests)
+            except Exception:
+                logger.exception('Failed to send notifications for %d rooms', len(rooms))
+
+
+notification_dispatcher = NotificationDispatcher()
@@ -0,0 +1,128 @@
+import math
+from base64 import b64decode, b64encode
+from urllib import parse
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class MessageCursorPagination(pagination.BasePagination):
+    """Keyset pagination over messages, newest first.
+
+    The cursor holds the `(created_when, id)` of the oldest message on the current page,
+    so every page (no matter how far back) is a range scan on the
+    `(room, created_when, id)` index instead of an OFFSET over the whole history.
+
+    Past the oldest message in the database, pages continue with the ones from `archive`
+    (see `chit_chat.retention.get_archived_messages`)."""
+    page_size = 50
+    max_page_size = 200
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None, archive=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            created_when, pk = position
+            queryset = queryset.filter(Q(created_when__lt=created_when) | Q(created_when=created_when, pk__lt=pk))
+
+        # Fetch one extra row to know whether there is another page, without a COUNT.
+        results = list(queryset.order_by('-created_when', '-pk')[:self.page_size + 1])
+        if archive is not None and len(results) <= self.page_size:
+            before = (results[-1].created_when, results[-1].pk) if results else position
+            results += archive(before, self.page_size + 1 - len(results))
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        return self.encode_cursor((last.created_when, last.pk))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            tokens = parse.parse_qs(b64decode(encoded.encode('ascii')).decode('ascii'), keep_blank_values=True)
+            position = self.parse_position(tokens)
+        except (TypeError, ValueError, KeyError, IndexError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if position is None:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def parse_position(self, tokens):
+        created_when = parse_datetime(tokens['t'][0])
+        if created_when is None:
+            return None
+        return created_when, int(tokens['i'][0])
+
+    def format_position(self, position):
+        created_when, pk = position
+        return {'t': created_when.isoformat(), 'i': pk}
+
+    def encode_cursor(self, position):
+        querystring = parse.urlencode(self.format_position(position), doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+
+class MessageSearchPagination(MessageCursorPagination):
+    """Keyset pagination over search results, best match first.
+
+    The cursor holds the `(rank, id)` of the last result on the current page, see
+    `chit_chat.search.search_messages`."""
+    page_size = 20
+
+    def paginate_search(self, search, request):
+        """`search(after, limit)` returns `(id, rank)` pairs."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        results = search(self.decode_cursor(request), self.page_size + 1)
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        pk, rank = self.page[-1]
+        return self.encode_cursor((rank, pk))
+
+    def parse_position(self, tokens):
+        rank = float(tokens['r'][0])
+        if not math.isfinite(rank):
+            return None
+        return rank, int(tokens['i'][0])
+
+    def format_position(self, position):
+        rank, pk = position
+        # repr round-trips floats exactly, so the next page starts right after this one
+        return {'r': repr(rank), 'i': pk}
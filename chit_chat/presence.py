@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.utils import timezone
+
+from .ckc_conf import chat_settings
+
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_STATUSES = ('online', 'away', 'offline')
+
+
+def _get_cache():
+    return caches[chat_settings['PRESENCE']['CACHE']]
+
+
+def _get_key(user_pk):
+    return f'chit_chat:presence:{user_pk}'
+
+
+def _get_sockets_key(user_pk):
+    return f'chit_chat:sockets:{user_pk}'
+
+
+def set_presence(user_pk, status):
+    """Records a user's status and when they were last seen. Entries expire after the
+    PRESENCE TTL, users that haven't been heard from since read as offline."""
+    presence = {'status': status, 'last_seen': timezone.now().isoformat()}
+    _get_cache().set(_get_key(user_pk), presence, chat_settings['PRESENCE']['TTL'])
+    return presence
+
+
+def set_online(user_pk):
+    """Records a user that just connected as online, unless they're already known to be around,
+    i.e. set `away` from another of their devices."""
+    presence = _get_cache().get(_get_key(user_pk))
+    if presence is None or presence['status'] == 'offline':
+        presence = set_presence(user_pk, 'online')
+    return presence
+
+
+def get_presence(user_pks):
+    """Status and last seen time of each of the users, one cache round trip for all of them."""
+    user_pks = list(user_pks)
+    found = _get_cache().get_many([_get_key(pk) for pk in user_pks])
+    return {
+        pk: found.get(_get_key(pk), {'status': 'offline', 'last_seen': None})
+        for pk in user_pks
+    }
+
+
+def socket_opened(user_pk):
+    """Counts one more open socket of the user, across processes. Returns how many are open."""
+    cache, key, ttl = _get_cache(), _get_sockets_key(user_pk), chat_settings['PRESENCE']['TTL']
+    cache.add(key, 0, ttl)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired in between
+        count = 1
+        cache.set(key, count, ttl)
+    cache.touch(key, ttl)
+    return count
+
+
+def socket_closed(user_pk):
+    """Counts one open socket of the user less, returns how many are still open."""
+    cache, key = _get_cache(), _get_sockets_key(user_pk)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        return 0
+    if count <= 0:
+        cache.delete(key)
+        return 0
+    return count
+
+
+def get_open_sockets(user_pks):
+    """How many sockets each of the users has open, one cache round trip for all of them."""
+    user_pks = list(user_pks)
+    found = _get_cache().get_many([_get_sockets_key(pk) for pk in user_pks])
+    return {pk: max(found.get(_get_sockets_key(pk), 0), 0) for pk in user_pks}
+
+
+def keep_alive(socket_counts):
+    """Keeps the socket counts and presence of users with sockets open here from expiring,
+    `socket_counts` being `{user pk: sockets open in this process}`."""
+    cache, ttl = _get_cache(), chat_settings['PRESENCE']['TTL']
+    for user_pk, count in socket_counts.items():
+        if not cache.touch(_get_sockets_key(user_pk), ttl):
+            # Evicted, or it lapsed while we weren't looking: at least ours are open
+            cache.add(_get_sockets_key(user_pk), count, ttl)
+        if not cache.touch(_get_key(user_pk), ttl):
+            set_presence(user_pk, 'online')
+
+
+class SocketHeartbeat:
+    """The sockets open in this process, per user. Calls `keep_alive` for them every third of
+    the PRESENCE TTL, so connected users never read as offline however quiet their clients
+    are. Counts left behind by a process that died without closing its sockets expire."""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._loop = None
+        self._task = None
+
+    def add(self, user_pk):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Same as `RoomRelay`, state belongs to one event loop (i.e. between tests)
+            self._counts, self._loop, self._task = Counter(), loop, None
+        self._counts[user_pk] += 1
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    def discard(self, user_pk):
+        self._counts[user_pk] -= 1
+        if self._counts[user_pk] <= 0:
+            del self._counts[user_pk]
+        if not self._counts and self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while self._counts:
+            await asyncio.sleep(chat_settings['PRESENCE']['TTL'] / 3)
+            try:
+                await sync_to_async(keep_alive)(dict(self._counts))
+            except Exception:
+                logger.exception('Failed to refresh presence of %d users', len(self._counts))
+
+
+socket_heartbeat = SocketHeartbeat()
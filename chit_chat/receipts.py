@@ -0,0 +1,96 @@
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import models
+from django.db.models import Case, Value, When
+
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.codecs import encode_event
+from chit_chat.models import RoomChange, RoomMembership
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReceiptWriter:
+    """Coalesces `read` receipts from every socket in this process.
+
+    Receipts arriving within FLUSH_INTERVAL of each other are merged, keeping the latest time
+    per member of a room, then saved with a single UPDATE per room. Each room then gets one
+    `read` event listing all of its receipts, instead of one event per receipt."""
+
+    def __init__(self):
+        # {room pk: {user pk: read until}}
+        self._pending = {}
+        self._loop = None
+        self._task = None
+        atexit.register(self.flush_remaining)
+
+    def put(self, room_pk, user_pk, until):
+        receipts = self._pending.setdefault(room_pk, {})
+        if user_pk not in receipts or receipts[user_pk] < until:
+            receipts[user_pk] = until
+        loop = asyncio.get_running_loop()
+        # A flush is already scheduled, unless it's done or the event loop changed under it
+        if self._loop is not loop or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._flush_later())
+
+    async def drain(self):
+        """Waits until everything received so far is saved and broadcast."""
+        if self._loop is asyncio.get_running_loop():
+            await self._task
+
+    async def _flush_later(self):
+        # Receipts that came in while the previous batch was being saved get their own batch
+        while self._pending:
+            await asyncio.sleep(chat_settings['READ_RECEIPTS']['FLUSH_INTERVAL'])
+            rooms, self._pending = self._pending, {}
+            try:
+                moved = await database_sync_to_async(self.write)(rooms)
+            except Exception:
+                logger.exception('Failed to save read receipts for %d rooms', len(rooms))
+                continue
+
+            channel_layer = get_channel_layer()
+            for room_pk, receipts in moved.items():
+                await channel_layer.group_send(str(room_pk), encode_event({
+                    'type': 'read',
+                    'room': room_pk,
+                    'readers': [{'user': user_pk, 'time': until.isoformat()} for user_pk, until in receipts.items()],
+                }))
+
+    def write(self, rooms):
+        """Saves the receipts, returns those that are now the members' watermarks. Receipts
+        older than what was already stored are left out, they'd announce a reader going back."""
+        moved = {}
+        for room_pk, receipts in rooms.items():
+            RoomMembership.objects.record_reads(room_pk, receipts)
+            # Compared in the database, so it's the stored value we match against
+            until = Case(
+                *[When(user_id=user_pk, then=Value(read_until)) for user_pk, read_until in receipts.items()],
+                output_field=models.DateTimeField(),
+            )
+            user_pks = list(RoomMembership.objects.filter(
+                room_id=room_pk, user_id__in=receipts, last_read_at=until,
+            ).values_list('user_id', flat=True))
+            if user_pks:
+                moved[room_pk] = {user_pk: receipts[user_pk] for user_pk in user_pks}
+
+        RoomChange.objects.record(
+            (room_pk, user_pk)
+            for room_pk, receipts in moved.items()
+            for user_pk in receipts
+        )
+        return moved
+
+    def flush_remaining(self):
+        """Synchronously saves whatever is still pending, runs at interpreter exit."""
+        rooms, self._pending = self._pending, {}
+        self.write(rooms)
+
+
+read_receipt_writer = ReadReceiptWriter()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before receiving again after the channel layer failed
+RETRY_DELAY = 1
+
+
+class RoomRelay:
+    """Delivers large rooms' events to the sockets in this process that are in them.
+
+    Normally every socket joins its rooms' channel layer groups, so a message to a room with
+    20k members is 20k channel layer sends. Sockets in rooms with LARGE_ROOM_MEMBERS or more
+    register here instead: the process joins the room's group once, with a channel of its
+    own, and hands each event it receives to the local sockets. Room groups keep their names,
+    so senders don't know the difference and sockets that joined a room's group before it
+    grew keep working alongside the relayed ones.
+
+    Events are routed by their `room` key, everything sent to a room group must have one.
+    They're handed over by sending them to each socket's own channel, so sockets handle them
+    one at a time along with the rest of their messages, not before they've finished
+    connecting."""
+
+    def __init__(self):
+        # {room pk: set of consumers}
+        self._rooms = {}
+        self._channel_layer = None
+        self._channel = None
+        self._loop = None
+        self._lock = None
+        self._tasks = []
+
+    async def subscribe(self, consumer, room_pks):
+        if not room_pks:
+            return
+        async with self._get_lock():
+            if self._channel is None:
+                await self._start(consumer.channel_layer)
+
+            new_room_pks = [pk for pk in room_pks if pk not in self._rooms]
+            for room_pk in room_pks:
+                self._rooms.setdefault(room_pk, set()).add(consumer)
+            for room_pk in new_room_pks:
+                await self._channel_layer.group_add(str(room_pk), self._channel)
+
+    async def unsubscribe(self, consumer, room_pks):
+        if not room_pks:
+            return
+        async with self._get_lock():
+            for room_pk in room_pks:
+                consumers = self._rooms.get(room_pk)
+                if consumers is None:
+                    continue
+                consumers.discard(consumer)
+                if not consumers:
+                    del self._rooms[room_pk]
+                    await self._channel_layer.group_discard(str(room_pk), self._channel)
+
+            if not self._rooms:
+                # Nothing left to relay, a new channel is made when something is
+                self._stop()
+
+    def _get_lock(self):
+        # State belongs to one event loop, start over if it changed (i.e. between tests)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._rooms, self._channel, self._tasks = {}, None, []
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _start(self, channel_layer):
+        self._channel_layer = channel_layer
+        self._channel = await channel_layer.new_channel()
+        self._tasks = [
+            self._loop.create_task(self._receive()),
+            self._loop.create_task(self._refresh()),
+        ]
+
+    def _stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._channel, self._tasks = None, []
+
+    async def _receive(self):
+        while True:
+            try:
+                event = await self._channel_layer.receive(self._channel)
+            except Exception:
+                # One layer error mustn't silence every relayed room in the process
+                logger.exception('Failed to receive relayed events, retrying')
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            consumers = self._rooms.get(event.get('room'))
+            if not consumers:
+                continue
+            # Passed on in the order they arrive, to every socket at once
+            results = await asyncio.gather(
+                *(self._channel_layer.send(consumer.channel_name, event) for consumer in list(consumers)),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error('Failed to relay a %s event', event['type'], exc_info=result)
+
+    async def _refresh(self):
+        # Group memberships expire, the relay's would otherwise go silent after a day
+        while True:
+            await asyncio.sleep(getattr(self._channel_layer, 'group_expiry', 86400) / 2)
+            try:
+                async with self._lock:
+                    for room_pk in list(self._rooms):
+                        await self._channel_layer.group_add(str(room_pk), self._channel)
+            except Exception:
+                logger.exception('Failed to refresh relayed room groups')
+
+
+room_relay = RoomRelay()
@@ -0,0 +1,113 @@
+from collections import deque
+
+from django.db.models import Q
+
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.models import Message
+
+
+class _RoomBuffer:
+    def __init__(self):
+        self.events = deque()
+        self.ids = set()
+        # Every message with a greater id has been seen, None until the first one is
+        self.complete_after = None
+
+
+class ReplayBuffer:
+    """The latest `chat` events of each room that a socket in this process is in, so clients
+    reconnecting after a short drop can be sent what they missed without a query.
+
+    A room's buffer only fills while some socket here is subscribed to the room, so it only
+    knows about the messages after the first one it saw (or after the newest one it evicted),
+    `get_since` returns None for anything older and the caller falls back to the database.
+    Messages without an id yet (see WRITE_BEHIND) can't be placed, seeing one starts the
+    room's buffer over."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._rooms = {}
+
+    def subscribe(self, room_pks):
+        for room_pk in room_pks:
+            self._subscribers[room_pk] = self._subscribers.get(room_pk, 0) + 1
+
+    def unsubscribe(self, room_pks):
+        for room_pk in room_pks:
+            count = self._subscribers.get(room_pk, 0) - 1
+            if count > 0:
+                self._subscribers[room_pk] = count
+            else:
+                # Nobody here will see the room's next messages, what we have stops being complete
+                self._subscribers.pop(room_pk, None)
+                self._rooms.pop(room_pk, None)
+
+    def append(self, event):
+        room_pk, message_id = event['room'], event['id']
+        if room_pk not in self._subscribers:
+            return
+        if message_id is None:
+            self._rooms.pop(room_pk, None)
+            return
+
+        buffer = self._rooms.setdefault(room_pk, _RoomBuffer())
+        # Every socket in the room hands us the same event
+        if message_id in buffer.ids:
+            return
+        if buffer.complete_after is None:
+            buffer.complete_after = message_id - 1
+
+        buffer.events.append(event)
+        buffer.ids.add(message_id)
+        while len(buffer.events) > chat_settings['REPLAY']['BUFFER_SIZE']:
+            evicted = buffer.events.popleft()
+            buffer.ids.discard(evicted['id'])
+            buffer.complete_after = max(buffer.complete_after, evicted['id'])
+
+    def get_since(self, room_pk, message_id):
+        """Events of the room's messages after `message_id` in id order, None when the buffer
+        can't tell."""
+        buffer = self._rooms.get(room_pk)
+        if buffer is None or message_id < buffer.complete_after:
+            return None
+        return sorted((event for event in buffer.events if event['id'] > message_id), key=lambda event: event['id'])
+
+    def clear(self):
+        self._subscribers.clear()
+        self._rooms.clear()
+
+
+replay_buffer = ReplayBuffer()
+
+
+def get_missed_messages(last_seen, limit):
+    """Messages after the given {room pk: message id}, one range scan of the room's
+    (room, created_when, id) index each. Returns them oldest first, along with the rooms whose
+    clients should refetch them instead: the message they last saw is gone or they missed more
+    than `limit` of them."""
+    anchors = {
+        room_id: (pk, created_when)
+        for pk, room_id, created_when in Message.objects.filter(pk__in=last_seen.values()).values_list(
+            'pk', 'room_id', 'created_when',
+        )
+        if last_seen.get(room_id) == pk
+    }
+
+    messages, resync_room_pks = [], []
+    for room_pk in last_seen:
+        if room_pk not in anchors:
+            resync_room_pks.append(room_pk)
+            continue
+
+        pk, created_when = anchors[room_pk]
+        missed = list(
+            # The bare lower bound is what lets the database seek instead of scanning the room
+            Message.objects.filter(room_id=room_pk, created_when__gte=created_when)
+            .filter(Q(created_when__gt=created_when) | Q(id__gt=pk))
+            .order_by('created_when', 'id')[:limit + 1]
+        )
+        if len(missed) > limit:
+            resync_room_pks.append(room_pk)
+        else:
+            messages += missed
+    return messages, resync_room_pks
@@ -0,0 +1,134 @@
+import gzip
+import json
+import time
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.models import Message, MessageArchive, Room, RoomMembership
+
+
+ARCHIVED_FIELDS = ('id', 'uuid', 'text', 'created_when', 'room_id', 'user_id')
+
+
+def get_archive_storage():
+    archive_dir = chat_settings['RETENTION']['ARCHIVE_DIR']
+    return FileSystemStorage(location=archive_dir) if archive_dir else None
+
+
+def get_retention_cutoff(room, now=None):
+    """Messages in the room sent before this are due, None when it keeps them forever."""
+    days = room.retention_days if room.retention_days is not None else chat_settings['RETENTION']['DAYS']
+    if days is None:
+        return None
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def prune_room(room, cutoff, batch_size, sleep=0, storage=None):
+    """Deletes the room's messages from before `cutoff`, oldest first, `batch_size` at a time
+    with a pause of `sleep` seconds in between. Each batch is one range of the room's
+    (room, created_when, id) index and its own short transaction, so writers are never held
+    up for long. With a `storage` every batch is written to an archive file before it's
+    deleted. Returns how many messages were removed."""
+    removed = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Message.objects.filter(room=room, created_when__lt=cutoff)
+                .order_by('created_when', 'id')
+                .values(*ARCHIVED_FIELDS)[:batch_size]
+            )
+            if not batch:
+                break
+            if storage is not None:
+                write_archive(room, batch, storage)
+            Message.objects.filter(pk__in=[message['id'] for message in batch]).delete()
+
+        removed += len(batch)
+        if len(batch) < batch_size:
+            break
+        time.sleep(sleep)
+
+    if removed:
+        RoomMembership.objects.filter(room=room).invalidate_room_lists()
+    return removed
+
+
+def write_archive(room, messages, storage):
+    oldest, newest = messages[0], messages[-1]
+    lines = ''.join(json.dumps(message, cls=DjangoJSONEncoder) + '\n' for message in messages)
+    path = storage.save(
+        f'{room.pk}/{oldest["id"]}-{newest["id"]}.jsonl.gz',
+        ContentFile(gzip.compress(lines.encode())),
+    )
+    return MessageArchive.objects.create(
+        room=room,
+        path=path,
+        count=len(messages),
+        oldest_when=oldest['created_when'],
+        oldest_id=oldest['id'],
+        newest_when=newest['created_when'],
+        newest_id=newest['id'],
+    )
+
+
+def read_archive(archive, storage):
+    """The archive's messages, oldest first, as unsaved Message instances."""
+    with storage.open(archive.path) as f:
+        lines = gzip.decompress(f.read()).decode().splitlines()
+
+    messages = []
+    for line in lines:
+        fields = json.loads(line)
+        fields['created_when'] = parse_datetime(fields['created_when'])
+        messages.append(Message(**fields))
+    return messages
+
+
+def get_archived_messages(room, before, limit):
+    """Up to `limit` archived messages of the room from before the `(created_when, id)`
+    position `before` (or the newest ones), newest first. Only the archive files covering
+    them are read."""
+    storage = get_archive_storage()
+    if storage is None:
+        return []
+
+    archives = MessageArchive.objects.filter(room=room).order_by('-newest_when', '-newest_id')
+    if before is not None:
+        created_when, pk = before
+        archives = archives.filter(Q(oldest_when__lt=created_when) | Q(oldest_when=created_when, oldest_id__lt=pk))
+
+    messages = []
+    for archive in archives.iterator():
+        older = [
+            message for message in reversed(read_archive(archive, storage))
+            if before is None or (message.created_when, message.pk) < before
+        ]
+        for message in older[:limit - len(messages)]:
+            # Already loaded, and what the serializer reads members' read state from
+            message.room = room
+            messages.append(message)
+        if len(messages) >= limit:
+            break
+    return messages
+
+
+def prune_messages(batch_size, sleep=0, archive=False, room_pks=None, now=None):
+    """Applies every room's retention policy, yields `(room, messages removed)` per room."""
+    storage = get_archive_storage() if archive else None
+    rooms = Room.objects.order_by('pk')
+    if room_pks:
+        rooms = rooms.filter(pk__in=room_pks)
+    now = now or timezone.now()
+
+    for room in rooms.iterator():
+        cutoff = get_retention_cutoff(room, now)
+        if cutoff is not None:
+            yield room, prune_room(room, cutoff, batch_size, sleep, storage)
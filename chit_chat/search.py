@@ -0,0 +1,86 @@
+import re
+
+from django.db import connection
+
+from chit_chat.models import Message, RoomMembership
+
+
+# Longer queries are cut short, every term is one more index lookup
+MAX_TERMS = 10
+
+
+def get_search_terms(query):
+    """Words of a search query, anything else (including FTS syntax) is dropped."""
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def search_messages(user_pk, terms, limit, after=None, room_pk=None):
+    """`(message id, rank)` of up to `limit` messages containing every one of `terms`, in the
+    rooms the user is a member of (or just `room_pk`), best match first.
+
+    Ranks are lower for better matches, ties go to the newest message. `after` is the
+    `(rank, id)` of the last result of the previous page.
+
+    SQLite matches against the `chit_chat_message_fts` FTS5 table and ranks by bm25,
+    PostgreSQL against the `to_tsvector('simple', text)` GIN index and ranks by ts_rank, both
+    set up by migration 0015. Other databases scan for each term, newest first. NOTE: SQLite
+    drops a table's triggers when a migration rebuilds it, a migration altering Message has
+    to create the triggers from 0015 again."""
+    vendor = connection.vendor
+    if vendor == 'sqlite' and has_fts_table():
+        matches = """
+            SELECT fts.rowid AS id, bm25(chit_chat_message_fts) AS rank
+            FROM chit_chat_message_fts AS fts
+            JOIN chit_chat_message AS message ON message.id = fts.rowid
+            WHERE chit_chat_message_fts MATCH %s AND {rooms}
+        """
+        # Every term quoted, so it's matched as a word and never parsed as FTS5 syntax
+        params = [' '.join(f'"{term}"' for term in terms)]
+    elif vendor == 'postgresql':
+        matches = """
+            SELECT message.id, -ts_rank(to_tsvector('simple', message.text), query) AS rank
+            FROM chit_chat_message AS message, plainto_tsquery('simple', %s) AS query
+            WHERE to_tsvector('simple', message.text) @@ query AND {rooms}
+        """
+        params = [' '.join(terms)]
+    else:
+        return search_messages_without_index(user_pk, terms, limit, after, room_pk)
+
+    if room_pk is None:
+        rooms = f'message.room_id IN (SELECT room_id FROM {RoomMembership._meta.db_table} WHERE user_id = %s)'
+        params.append(user_pk)
+    else:
+        rooms = f'message.room_id = %s AND EXISTS (SELECT 1 FROM {RoomMembership._meta.db_table} WHERE room_id = %s AND user_id = %s)'
+        params += [room_pk, room_pk, user_pk]
+
+    sql = f'SELECT id, rank FROM ({matches.format(rooms=rooms)}) AS matches'
+    if after is not None:
+        sql += ' WHERE rank > %s OR (rank = %s AND id < %s)'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY rank, id DESC LIMIT %s'
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def search_messages_without_index(user_pk, terms, limit, after=None, room_pk=None):
+    messages = Message.objects.filter(room__memberships__user=user_pk)
+    if room_pk is not None:
+        messages = messages.filter(room=room_pk)
+    for term in terms:
+        messages = messages.filter(text__icontains=term)
+    if after is not None:
+        messages = messages.filter(id__lt=after[1])
+    return [(pk, 0.0) for pk in messages.order_by('-id').values_list('pk', flat=True)[:limit]]
+
+
+_fts_tables = {}
+
+
+def has_fts_table():
+    # SQLite may have been built without FTS5, see migration 0015
+    if connection.alias not in _fts_tables:
+        _fts_tables[connection.alias] = 'chit_chat_message_fts' in connection.introspection.table_names()
+    return _fts_tables[connection.alias]
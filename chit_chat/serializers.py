@@ -1,7 +1,7 @@
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.contrib.auth import get_user_model
-from django.db.models import Count
+from django.db import IntegrityError, transaction
 from rest_framework import serializers, exceptions
 
 from chit_chat.models import Room, Message
@@ -13,6 +13,8 @@ User = get_user_model()
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    users_who_viewed = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
         fields = (
@@ -24,6 +26,16 @@ class MessageSerializer(serializers.ModelSerializer):
             'users_who_viewed',
         )
 
+    def get_users_who_viewed(self, message):
+        # Derived from the members' read watermarks, expects the room's memberships to be prefetched
+        return [
+            membership.user_id
+            for membership in message.room.memberships.all()
+            if membership.user_id == message.user_id or (
+                membership.last_read_at is not None and membership.last_read_at >= message.created_when
+            )
+        ]
+
 
 class ChatUserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -38,9 +50,12 @@ class ChatUserSerializer(serializers.ModelSerializer):
 
 class RoomSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(read_only=True, many=True)
+    unread_count = serializers.SerializerMethodField()
+    last_read_at = serializers.SerializerMethodField()
     members = PrimaryKeyWriteSerializerReadField(
         queryset=User.objects.all(),
         read_serializer=chat_settings['SERIALIZERS'].USER,
+        display_field=User.USERNAME_FIELD,
         many=True,
     )
 
@@ -50,8 +65,24 @@ class RoomSerializer(serializers.ModelSerializer):
             'id',
             'messages',
             'members',
+            'unread_count',
+            'last_read_at',
         )
 
+    def get_requestor_membership(self, room):
+        requestor = self.context['request'].user
+        for membership in room.memberships.all():
+            if membership.user_id == requestor.pk:
+                return membership
+
+    def get_unread_count(self, room):
+        membership = self.get_requestor_membership(room)
+        return membership.unread_count if membership else 0
+
+    def get_last_read_at(self, room):
+        membership = self.get_requestor_membership(room)
+        return membership.last_read_at if membership else None
+
     def validate_members(self, users):
         requestor = self.context['request'].user
         non_requestor_users = [user for user in users if user != requestor]
@@ -62,13 +93,57 @@ class RoomSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         member_pks = [member.pk for member in validated_data['members']]
+        member_signature = Room.get_member_signature(member_pks)
 
-        room = Room.objects.filter(members__in=member_pks).annotate(member_count=Count('members')).filter(member_count=len(member_pks)).first()
-        room = room or super().create(validated_data)
+        room = Room.objects.filter(member_signature=member_signature).first()
+        if room is None:
+            try:
+                with transaction.atomic():
+                    room = super().create({**validated_data, 'member_signature': member_signature})
+            except IntegrityError:
+                # Someone created the same room concurrently, theirs won the unique signature
+                room = Room.objects.get(member_signature=member_signature)
 
         # Reconnect members
         channel_layer = get_channel_layer()
         for pk in member_pks:
-            async_to_sync(channel_layer.group_send)(f"user-{pk}", {"type": "refresh_group_add"})
+            async_to_sync(channel_layer.group_send)(f"user-{pk}", {"type": "refresh_group_add", "rooms": [room.pk]})
 
         return room
+
+
+class SyncMessageSerializer(serializers.ModelSerializer):
+    """Messages as returned by the sync endpoint, read state comes with the rooms instead."""
+
+    class Meta:
+        model = Message
+        fields = (
+            'id',
+            'uuid',
+            'text',
+            'created_when',
+            'room',
+            'user',
+        )
+
+
+class SyncRoomSerializer(RoomSerializer):
+    """A room's state without its messages, which sync returns separately, plus every member's
+    read watermark. Expects memberships to be prefetched."""
+    messages = None
+    read_states = serializers.SerializerMethodField()
+
+    class Meta(RoomSerializer.Meta):
+        fields = (
+            'id',
+            'members',
+            'unread_count',
+            'last_read_at',
+            'read_states',
+        )
+
+    def get_read_states(self, room):
+        return [
+            {'user': membership.user_id, 'last_read_at': membership.last_read_at}
+            for membership in room.memberships.all()
+        ]
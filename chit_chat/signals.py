@@ -0,0 +1,74 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from chit_chat.cache import membership_cache
+from chit_chat.models import Room, RoomChange, RoomMembership
+
+
+def memberships_changed(rooms, user_pks, removed=False):
+    """Keeps everything derived from a room's member list in sync, takes rooms or their pks."""
+    user_pks = list(user_pks)
+    room_pks = [room.pk if isinstance(room, Room) else room for room in rooms]
+    membership_cache.invalidate(*user_pks)
+
+    def committed():
+        # A socket racing the current transaction could have cached the old rooms again
+        membership_cache.invalidate(*user_pks)
+        if removed:
+            # Open sockets of the removed members, in any process, leave the rooms right away
+            channel_layer = get_channel_layer()
+            for user_pk in user_pks:
+                async_to_sync(channel_layer.group_send)(f'user-{user_pk}', {'type': 'refresh_group_discard', 'rooms': room_pks})
+
+    transaction.on_commit(committed)
+    RoomChange.objects.record(
+        (room_pk, user_pk)
+        for room_pk in room_pks
+        for user_pk in user_pks
+    )
+
+    if not all(isinstance(room, Room) for room in rooms):
+        rooms = Room.objects.filter(pk__in=rooms)
+    for room in rooms:
+        room.refresh_member_signature()
+
+
+@receiver(post_save, sender=RoomMembership)
+def membership_saved(sender, instance, created, **kwargs):
+    if created:
+        memberships_changed([instance.room_id], [instance.user_id])
+    else:
+        # i.e. settings like `archived`, synced to the member's other devices
+        RoomChange.objects.record([(instance.room_id, instance.user_id)])
+
+
+@receiver(post_delete, sender=RoomMembership)
+def membership_deleted(sender, instance, **kwargs):
+    memberships_changed([instance.room_id], [instance.user_id], removed=True)
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # `room.members.add(...)` and friends bulk insert/delete memberships without firing save signals
+    if action == 'pre_clear':
+        # `pk_set` is empty for clears, remember what is about to go
+        if reverse:
+            cleared = instance.chat_room_memberships.values_list('room_id', flat=True)
+        else:
+            cleared = instance.memberships.values_list('user_id', flat=True)
+        instance._chit_chat_cleared_pks = list(cleared)
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    changed_pks = instance._chit_chat_cleared_pks if action == 'post_clear' else pk_set
+    removed = action != 'post_add'
+    if reverse:
+        # Called from the user side, e.g. `user.chat_rooms.add(room)`
+        memberships_changed(changed_pks, [instance.pk], removed)
+    else:
+        # Passing the instance along keeps the caller's copy of the room up to date
+        memberships_changed([instance], changed_pks, removed)
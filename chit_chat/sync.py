@@ -0,0 +1,68 @@
+import re
+from collections import namedtuple
+
+from django.db.models import Q
+from rest_framework import exceptions
+
+from chit_chat.models import Message, Room, RoomChange, RoomMembership
+
+
+class SyncToken(namedtuple('SyncToken', ['change_id', 'message_id'])):
+    """Position in the changelog and in the messages table, both only ever grow. Sent to
+    clients as "<change_id>.<message_id>"."""
+    pattern = re.compile(r'^(\d+)\.(\d+)$')
+
+    @classmethod
+    def parse(cls, token):
+        match = cls.pattern.match(token)
+        if match is None:
+            raise exceptions.ValidationError({'since': ['Invalid sync token.']})
+        return cls(int(match.group(1)), int(match.group(2)))
+
+    @classmethod
+    def current(cls):
+        return cls(
+            RoomChange.objects.order_by('-id').values_list('id', flat=True).first() or 0,
+            Message.objects.order_by('-id').values_list('id', flat=True).first() or 0,
+        )
+
+    def __str__(self):
+        return f'{self.change_id}.{self.message_id}'
+
+
+def get_changes(user, since, limit):
+    """What changed in the user's rooms after `since`: at most `limit` changelog rows and
+    `limit` messages, in id order.
+
+    Returns the changed rooms (members, read state) the user is still in, the changed rooms they
+    aren't in any more, the new messages, the token to continue from and whether there's more.
+
+    Ids are handed out when rows are inserted, not when their transaction commits, so a slow
+    transaction can commit a row below a token a client already has. Clients doing a full
+    refresh now and then pick those up."""
+    user_room_ids = RoomMembership.objects.filter(user=user).values('room_id')
+
+    changes = list(
+        RoomChange.objects.filter(Q(room_id__in=user_room_ids) | Q(user=user), id__gt=since.change_id)
+        .order_by('id').values_list('id', 'room_id')[:limit + 1]
+    )
+    messages = list(
+        Message.objects.filter(room_id__in=user_room_ids, id__gt=since.message_id).order_by('id')[:limit + 1]
+    )
+    more = len(changes) > limit or len(messages) > limit
+    changes, messages = changes[:limit], messages[:limit]
+
+    changed_room_ids = {room_id for _, room_id in changes}
+    rooms = []
+    if changed_room_ids:
+        rooms = list(
+            Room.objects.filter(pk__in=changed_room_ids, memberships__user=user)
+            .order_by('pk').prefetch_related('members', 'memberships')
+        )
+    left_room_ids = sorted(changed_room_ids - {room.pk for room in rooms})
+
+    token = SyncToken(
+        changes[-1][0] if changes else since.change_id,
+        messages[-1].pk if messages else since.message_id,
+    )
+    return rooms, left_room_ids, messages, token, more
@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+
+from .ckc_conf import chat_settings
+
+
+class TokenBucket:
+    """Allows `RATE` frames per second on average and bursts of up to `BURST` frames."""
+
+    def __init__(self, options):
+        self.options = options
+        self.tokens = options['BURST']
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available right now."""
+        rate = self.options['RATE']
+        self.tokens = min(self.options['BURST'], self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class TokenBuckets:
+    """A token bucket per key for one RATE_LIMITS scope, e.g. per user or per room. Only the
+    most recently used `max_size` keys are kept, a forgotten bucket was full anyway unless
+    its key was flooding and then pushed out by `max_size` other keys."""
+
+    def __init__(self, scope, max_size=10000):
+        self.scope = scope
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def get(self, key):
+        """Bucket for `key`, None when this scope isn't limited."""
+        options = chat_settings['RATE_LIMITS'][self.scope]
+        if options is None:
+            return None
+
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.options != options:
+            bucket = self._buckets[key] = TokenBucket(options)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+        return bucket
+
+    def clear(self):
+        self._buckets.clear()
+
+
+def take_tokens(buckets):
+    """Takes a token from each of the `(scope, bucket)` pairs, or from none of them if any one
+    is empty. Returns None on success, otherwise `(scope, seconds to wait)` of the first
+    empty bucket."""
+    now = time.monotonic()
+    buckets = [(scope, bucket) for scope, bucket in buckets if bucket is not None]
+    for scope, bucket in buckets:
+        wait = bucket.wait_time(now)
+        if wait:
+            return scope, wait
+    for _, bucket in buckets:
+        bucket.take()
+    return None
+
+
+# Shared by every socket in this process
+user_buckets = TokenBuckets('USER')
+room_buckets = TokenBuckets('ROOM')
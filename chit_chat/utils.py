@@ -1,6 +1,29 @@
 from collections import OrderedDict
 
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
+
+from .ckc_conf import chat_settings
+
+
+def get_serialized_model_fields(serializer_class):
+    """Names of the model fields a ModelSerializer reads, to load only those with `.only()`.
+    Returns None when that can't be told from `Meta.fields`, i.e. for method fields that
+    could read anything."""
+    meta = getattr(serializer_class, 'Meta', None)
+    fields = getattr(meta, 'fields', None)
+    if not isinstance(fields, (list, tuple)) or not hasattr(meta, 'model'):
+        return None
+
+    model_fields = {field.name for field in meta.model._meta.concrete_fields} | {'pk'}
+    if serializer_class._declared_fields or not set(fields) <= model_fields:
+        return None
+    return list(fields)
+
+
+class BatchedManyRelatedField(serializers.ManyRelatedField):
+    def to_representation(self, iterable):
+        return self.child_relation.to_representation_many(iterable)
 
 
 #  TODO: This should be stored in the django-ckc package
@@ -10,37 +33,68 @@ class PrimaryKeyWriteSerializerReadField(serializers.PrimaryKeyRelatedField):
         assert read_serializer is not None, (
             'PrimaryKeyWriteSerializerReadField must provide `read_serializer` argument.'
         )
+        # Column shown next to each pk in the browsable API's choices, defaults to the pk itself
+        self.display_field = kwargs.pop('display_field', None)
         super().__init__(*args, **kwargs)
         self.read_serializer = read_serializer
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        # Same as RelatedField.many_init, but reads every related object of a parent at once
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BatchedManyRelatedField(**list_kwargs)
+
     # Related fields will not look up any of the object's values for normal primary
     # key serialization. This override forces the lookup of the entire object.
     def use_pk_only_optimization(self):
         return False
 
+    def get_representation_cache(self):
+        # Shared by every instance of this field within the response being rendered, so an
+        # object related to many parents (i.e. a user in many rooms) is only serialized once.
+        root = self.root
+        if not hasattr(root, '_read_serializer_cache'):
+            root._read_serializer_cache = {}
+        return root._read_serializer_cache.setdefault((self.read_serializer, self.field_name), {})
+
     def to_representation(self, value, pk_only=False):
         if pk_only:
             # Returning just the PK so dropdowns can render this as an option in DRF browsable API
             return value.pk
         else:
             # Returning full dict representation for reading normally
-            return self.read_serializer(value, context=self.context).data
+            return self.to_representation_many([value])[0]
+
+    def to_representation_many(self, values):
+        values = list(values)
+        cache = self.get_representation_cache()
+
+        missing = list({value.pk: value for value in values if value.pk not in cache}.values())
+        if missing:
+            data = self.read_serializer(missing, many=True, context=self.context).data
+            cache.update(zip((value.pk for value in missing), data))
+
+        return [cache[value.pk] for value in values]
 
     def get_choices(self, cutoff=None):
-        """Overriding this base method to change to_representation so it passes pk_only=True"""
+        """Overriding this base method to only ever load up to `CHOICES_LIMIT` (pk, display_field)
+        rows, instead of a model instance for every row in the table."""
         queryset = self.get_queryset()
         if queryset is None:
             # Ensure that field.choices returns something sensible
             # even when accessed with a read-only field.
             return {}
 
-        if cutoff is not None:
-            queryset = queryset[:cutoff]
+        # DRF asks for every choice (no cutoff) from `field.choices`
+        limit = chat_settings['CHOICES_LIMIT']
+        if cutoff is None or cutoff > limit:
+            cutoff = limit
 
-        return OrderedDict([
-            (
-                self.to_representation(item, pk_only=True),
-                self.display_value(item)
-            )
-            for item in queryset
-        ])
+        if self.display_field is None:
+            rows = ((pk, pk) for pk in queryset.values_list('pk', flat=True)[:cutoff].iterator())
+        else:
+            rows = queryset.values_list('pk', self.display_field)[:cutoff].iterator()
+        return OrderedDict((pk, str(display)) for pk, display in rows)
@@ -1,10 +1,21 @@
-from rest_framework import viewsets, mixins
-from django.db.models import Max
+from rest_framework import viewsets, mixins, exceptions, status
+from django.db.models import OuterRef, Prefetch, Q, Subquery, Value
+from django.db.models.query import prefetch_related_objects
+from django.http import Http404
+from django.utils.http import parse_etags
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from chit_chat.models import Room
-from chit_chat.serializers import RoomSerializer
+from chit_chat.cache import room_list_cache
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.models import Room, RoomChange, RoomMembership, Message
+from chit_chat.pagination import MessageCursorPagination, MessageSearchPagination
+from chit_chat.presence import get_presence
+from chit_chat.retention import get_archived_messages
+from chit_chat.search import get_search_terms, search_messages
+from chit_chat.serializers import RoomSerializer, MessageSerializer, SyncMessageSerializer, SyncRoomSerializer
+from chit_chat.sync import SyncToken, get_changes
+from chit_chat.utils import get_serialized_model_fields
 
 
 class RoomViewSet(
@@ -14,19 +25,204 @@ class RoomViewSet(
 ):
     queryset = Room.objects.all()
     serializer_class = RoomSerializer
+    lookup_value_regex = r'\d+'
 
     def get_queryset(self):
-        qs = super().get_queryset().filter(members=self.request.user)
-        qs = qs.annotate(latest_message_time=Max('messages__created_when')).order_by('-latest_message_time')
-        qs = qs.prefetch_related(
-            'messages',
-            'messages__users_who_viewed',
-            'members',
+        if self.action != 'list':
+            # Detail actions only need the membership check, archived rooms included
+            return super().get_queryset().filter(memberships__user=self.request.user)
+
+        # One filter() call, so both conditions apply to the requestor's own membership. Value()
+        # compares `archived = %s`, a bare boolean is written as `NOT archived` which SQLite
+        # can't look up in an index. Ties are broken on the membership's room rather than the
+        # room's pk (the same thing), so the (user, archived, last_message_at, room) index
+        # gives the order and every page is one range of it.
+        qs = super().get_queryset().filter(
+            memberships__user=self.request.user,
+            memberships__archived=Value(self.get_archived()),
+        )
+        qs = qs.order_by('-memberships__last_message_at', '-memberships__room')
+
+        message_limit = self.get_message_limit()
+        if message_limit is None:
+            qs = qs.prefetch_related('messages')
+        elif message_limit > 0:
+            # Position of the Nth newest message in each room, messages are prefetched from
+            # there onwards once we know which rooms are on the page (see `list`).
+            latest = Message.objects.filter(room=OuterRef('pk')).order_by('-created_when', '-id')[message_limit - 1:message_limit]
+            qs = qs.annotate(
+                message_cutoff_when=Subquery(latest.values('created_when')),
+                message_cutoff_id=Subquery(latest.values('id')),
+            )
+        return qs.prefetch_related(self.get_members_prefetch(), 'memberships')
+
+    def get_members_prefetch(self):
+        # Members are only rendered through the USER serializer, load just what it reads
+        user_serializer = chat_settings['SERIALIZERS'].USER
+        fields = get_serialized_model_fields(user_serializer)
+        if fields is None:
+            return 'members'
+        return Prefetch('members', queryset=user_serializer.Meta.model.objects.only(*fields))
+
+    def get_archived(self):
+        archived = self.request.query_params.get('archived', 'false')
+        if archived not in ('true', 'false'):
+            raise exceptions.ValidationError({'archived': ['Must be "true" or "false".']})
+        return archived == 'true'
+
+    def get_message_limit(self):
+        message_limit = self.request.query_params.get('message_limit', chat_settings['ROOM_MESSAGE_LIMIT'])
+        if message_limit is None:
+            return None
+        try:
+            message_limit = int(message_limit)
+        except (TypeError, ValueError):
+            message_limit = -1
+        if message_limit < 0:
+            raise exceptions.ValidationError({'message_limit': ['Must be a positive integer.']})
+        return message_limit
+
+    def list(self, request, *args, **kwargs):
+        if not chat_settings['ROOM_LIST_CACHE']['ENABLED']:
+            return self.build_list_response()
+
+        # Unchanged since the client's copy (or ours) means no queries at all
+        etag = room_list_cache.get_etag(request.user.pk, f'{request.accepted_renderer.format}:{request.build_absolute_uri()}')
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        data = room_list_cache.get(request.user.pk, etag)
+        if data is None:
+            data = self.build_list_response().data
+            room_list_cache.set(request.user.pk, etag, data)
+        return Response(data, headers={'ETag': etag})
+
+    def build_list_response(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        rooms = page if page is not None else list(queryset)
+        self.prefetch_latest_messages(rooms)
+
+        serializer = self.get_serializer(rooms, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+    def prefetch_latest_messages(self, rooms):
+        message_limit = self.get_message_limit()
+        if message_limit is None:
+            return
+
+        messages = Message.objects.none()
+        if message_limit > 0 and rooms:
+            # One query for the whole page, each room being an index range scan from its cutoff
+            in_window = Q()
+            for room in rooms:
+                if room.message_cutoff_id is None:
+                    # Fewer messages than the limit, all of them fit
+                    in_window |= Q(room=room.pk)
+                else:
+                    in_window |= Q(room=room.pk) & (
+                        Q(created_when__gt=room.message_cutoff_when) |
+                        Q(created_when=room.message_cutoff_when, id__gte=room.message_cutoff_id)
+                    )
+            messages = Message.objects.filter(in_window).order_by('created_when', 'id')
+        prefetch_related_objects(rooms, Prefetch('messages', queryset=messages))
+
+    @action(methods=['get'], detail=True)
+    def messages(self, request, pk, *args, **kwargs):
+        room = self.get_object()
+        prefetch_related_objects([room], 'memberships')
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(
+            room.messages.all(), request, view=self,
+            archive=lambda before, limit: get_archived_messages(room, before, limit),
+        )
+        serializer = MessageSerializer(page, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(methods=['get'], detail=False)
+    def search(self, request, *args, **kwargs):
+        """Messages matching every word of `?q=`, in all of your rooms or just `?room=<id>`."""
+        terms = get_search_terms(request.query_params.get('q', ''))
+        if not terms:
+            raise exceptions.ValidationError({'q': ['Enter something to search for.']})
+        room_pk = request.query_params.get('room')
+        if room_pk is not None:
+            if not room_pk.isdigit():
+                raise exceptions.ValidationError({'room': ['Must be a room id.']})
+            room_pk = int(room_pk)
+
+        paginator = MessageSearchPagination()
+        page = paginator.paginate_search(
+            lambda after, limit: search_messages(request.user.pk, terms, limit, after, room_pk),
+            request,
         )
-        return qs
+        messages = Message.objects.select_related('room').prefetch_related('room__memberships').in_bulk(
+            [pk for pk, _ in page]
+        )
+        serializer = MessageSerializer(
+            [messages[pk] for pk, _ in page if pk in messages], many=True, context=self.get_serializer_context(),
+        )
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(methods=['get'], detail=True)
+    def presence(self, request, pk, *args, **kwargs):
+        # Initial state for clients, changes after that arrive over the websocket
+        room = self.get_object()
+        presence = get_presence(room.memberships.values_list('user_id', flat=True))
+        return Response([{'user': user_pk, **state} for user_pk, state in presence.items()])
 
     @action(methods=['post'], detail=True)
     def viewed_all_messages(self, request, pk, *args, **kwargs):
-        room = self.get_object()
-        request.user.chat_room_messages_viewed.add(*room.messages.all())
+        """Marks the room read, or only up to and including `message` (an id) when given."""
+        # Moving the read watermark is a single UPDATE, no matter how many messages the room has
+        memberships = RoomMembership.objects.filter(room=pk, user=request.user)
+        message_pk = request.data.get('message')
+        if message_pk is None:
+            if not memberships.mark_read():
+                raise Http404
+        else:
+            until = self.get_read_until(pk, message_pk)
+            if not RoomMembership.objects.record_reads(pk, {request.user.pk: until}):
+                # Already read past it, nothing changed
+                return Response()
+        RoomChange.objects.record([(pk, request.user.pk)])
         return Response()
+
+    def get_read_until(self, room_pk, message_pk):
+        try:
+            message_pk = int(message_pk)
+        except (TypeError, ValueError):
+            raise exceptions.ValidationError({'message': ['Must be a message id.']})
+
+        # Membership is checked by the same query
+        until = Message.objects.filter(
+            pk=message_pk, room=room_pk, room__memberships__user=self.request.user,
+        ).values_list('created_when', flat=True).first()
+        if until is None:
+            if not RoomMembership.objects.filter(room=room_pk, user=self.request.user).exists():
+                raise Http404
+            raise exceptions.ValidationError({'message': ['Not a message in this room.']})
+        return until
+
+    @action(methods=['get'], detail=False)
+    def sync(self, request, *args, **kwargs):
+        """Changes since `?since=<token>`, follow `token` while `more` is true. Without a token
+        this only returns the current one: take it, then load rooms the usual way and sync
+        from there on."""
+        since = request.query_params.get('since')
+        if since is None:
+            return Response({'token': str(SyncToken.current())})
+
+        rooms, left_room_ids, messages, token, more = get_changes(
+            request.user, SyncToken.parse(since), chat_settings['SYNC_PAGE_SIZE'],
+        )
+        context = self.get_serializer_context()
+        return Response({
+            'token': str(token),
+            'more': more,
+            'rooms': SyncRoomSerializer(rooms, many=True, context=context).data,
+            'left_rooms': left_room_ids,
+            'messages': SyncMessageSerializer(messages, many=True, context=context).data,
+        })
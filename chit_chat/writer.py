@@ -0,0 +1,108 @@
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.db import transaction
+
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.models import Message
+from chit_chat.notifications import notification_dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_messages(messages):
+    """Saves a batch of messages and their room state, one INSERT for all of them."""
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+
+        # Not every database hands back primary keys from a bulk insert
+        unsaved = {message.uuid: message for message in messages if message.pk is None}
+        if unsaved:
+            for message_uuid, pk in Message.objects.filter(uuid__in=unsaved).values_list('uuid', 'pk'):
+                unsaved[message_uuid].pk = pk
+
+        Message.objects.update_room_state(messages)
+
+
+class MessageWriter:
+    """Write-behind persistence for chat messages, used when WRITE_BEHIND is enabled.
+
+    Durability: a message is broadcast before it is saved. It reaches the database within
+    FLUSH_INTERVAL seconds (or as soon as BATCH_SIZE messages are waiting), queued messages
+    are flushed at interpreter exit, but anything still queued when a process is killed is
+    lost. A batch that fails to save is logged and dropped. Once MAX_QUEUE_SIZE messages are
+    waiting, `put` blocks, slowing down senders until the database catches up."""
+
+    def __init__(self):
+        self._loop = None
+        self._queue = None
+        self._task = None
+        atexit.register(self.flush_remaining)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._task.done():
+            return
+        # Event loop changed (i.e. a server reload), carry over whatever the old one left behind
+        leftover = self._take_queued() if self._queue is not None else []
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=chat_settings['WRITE_BEHIND']['MAX_QUEUE_SIZE'])
+        for message in leftover:
+            self._queue.put_nowait(message)
+        self._task = loop.create_task(self._run())
+
+    async def put(self, message):
+        self.start()
+        await self._queue.put(message)
+
+    async def drain(self):
+        """Waits until everything queued so far is saved."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await database_sync_to_async(write_messages)(batch)
+            except Exception:
+                logger.exception('Failed to save %d chat messages', len(batch))
+            else:
+                notification_dispatcher.put(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _next_batch(self):
+        options = chat_settings['WRITE_BEHIND']
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + options['FLUSH_INTERVAL']
+        while len(batch) < options['BATCH_SIZE']:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _take_queued(self):
+        messages = []
+        while not self._queue.empty():
+            messages.append(self._queue.get_nowait())
+            self._queue.task_done()
+        return messages
+
+    def flush_remaining(self):
+        """Synchronously saves whatever is still queued, runs at interpreter exit."""
+        if self._queue is not None:
+            messages = self._take_queued()
+            if messages:
+                write_messages(messages)
+
+
+message_writer = MessageWriter()
@@ -72,6 +72,9 @@ REST_FRAMEWORK = {
     # )
 }
 
+# Tests run in a single process, the default LocMemCache is shared by everything
+CKC_CHAT_ROOM_LIST_CACHE = {'ENABLED': True}
+
 
 # =============================================================================
 # Channels
@@ -38,3 +38,8 @@ class MessageFactory(DjangoModelFactory):
     text = factory.Faker('text')
     user = factory.SubFactory(UserFactory)
     room = factory.SubFactory(RoomFactory)
+
+    @factory.post_generation
+    def room_state(self, created, extracted):
+        if created:
+            self.update_room_state()
@@ -1,12 +1,38 @@
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.forms import modelform_factory
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from rest_framework.test import APITestCase
 
+from chit_chat.ckc_conf import chat_settings
+from chit_chat.consumer_serializers import ChatMessageSerializer
+from chit_chat.models import Message, MessageArchive, Room, RoomMembership
+from chit_chat.presence import set_presence
+from chit_chat.receipts import read_receipt_writer
+from chit_chat.serializers import ChatUserSerializer, RoomSerializer
+from chit_chat.throttling import room_buckets
 from testproject.testapp.factories import RoomFactory, MessageFactory, UserFactory
 
 
+User = get_user_model()
+
+
 class TestChat(APITestCase):
     def setUp(self):
+        # Cached room lists would outlive the rows they were built from
+        cache.clear()
         self.user = UserFactory()
         self.client.force_authenticate(self.user)
 
@@ -29,6 +55,40 @@ class TestChat(APITestCase):
         assert resp.status_code == 201
         assert room_id == resp.json()['id']
 
+    def test_create_room_does_not_return_room_with_more_members(self):
+        other_user = UserFactory()
+        group_room = RoomFactory(members=[self.user, other_user, UserFactory()])
+
+        resp = self.client.post(reverse('room-list'), data={'members': [self.user.pk, other_user.pk]})
+        assert resp.status_code == 201
+        assert resp.json()['id'] != group_room.pk
+
+        # Existing rooms are found by their exact member list
+        direct_room_id = resp.json()['id']
+        resp = self.client.post(reverse('room-list'), data={'members': [other_user.pk, self.user.pk]})
+        assert resp.json()['id'] == direct_room_id
+
+    def test_member_signature_follows_membership_changes(self):
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        room.refresh_from_db()
+        assert room.member_signature == Room.get_member_signature([other_user.pk, self.user.pk])
+
+        third_user = UserFactory()
+        room.members.add(third_user)
+        room.refresh_from_db()
+        assert room.member_signature == Room.get_member_signature([self.user.pk, other_user.pk, third_user.pk])
+        assert room.member_count == 3
+
+        # Only one room can be the canonical room for a set of members
+        duplicate_room = RoomFactory(members=[self.user, other_user])
+        room.members.remove(third_user)
+        room.refresh_from_db()
+        assert room.member_signature is None
+        assert room.member_count == 2
+        duplicate_room.refresh_from_db()
+        assert duplicate_room.member_signature == Room.get_member_signature([self.user.pk, other_user.pk])
+
     def test_room_create_requires_another_user(self):
         room_data = {
             'members': [self.user.pk]
@@ -84,6 +144,49 @@ class TestChat(APITestCase):
         assert data[0]['id'] == room_1.pk
         assert data[1]['id'] == room_2.pk
 
+    def test_archived_rooms_are_listed_separately(self):
+        room = RoomFactory(members=[self.user, UserFactory()])
+        archived_room = RoomFactory(members=[self.user])
+        RoomMembership.objects.filter(room=archived_room, user=self.user).update(archived=True)
+        # Someone else archiving it doesn't hide it from us
+        RoomMembership.objects.filter(room=room).exclude(user=self.user).update(archived=True)
+
+        resp = self.client.get(reverse('room-list'))
+        assert [room['id'] for room in resp.json()['results']] == [room.pk]
+        resp = self.client.get(reverse('room-list'), data={'archived': 'true'})
+        assert [room['id'] for room in resp.json()['results']] == [archived_room.pk]
+        assert resp.json()['count'] == 1
+
+        resp = self.client.get(reverse('room-list'), data={'archived': 'maybe'})
+        assert resp.status_code == 400
+        assert 'archived' in resp.json()
+
+        # Still there for everything else
+        resp = self.client.get(reverse('room-messages', args=(archived_room.pk,)))
+        assert resp.status_code == 200
+
+    def test_latest_message_is_denormalized_onto_room(self):
+        room = RoomFactory(members=[self.user])
+        MessageFactory(room=room)
+        message = MessageFactory(room=room)
+
+        room.refresh_from_db()
+        assert room.last_message == message
+        assert room.last_message_at == message.created_when
+        assert room.memberships.get(user=self.user).last_message_at == message.created_when
+
+        # New rooms without any messages sort by when they were joined
+        new_room = RoomFactory(members=[self.user])
+        with self.assertNumQueries(4):
+            resp = self.client.get(reverse('room-list'), data={'message_limit': 0})
+        assert [room['id'] for room in resp.json()['results']] == [new_room.pk, room.pk]
+
+    def test_room_forms_dont_offer_every_message(self):
+        # i.e. the admin's, which would render a <select> of the whole message table
+        form = modelform_factory(Room, fields='__all__')
+        assert 'last_message' not in form.base_fields
+        assert 'last_message_at' not in form.base_fields
+
     def test_mark_all_messages_in_room_as_viewed(self):
         room_1 = RoomFactory(members=[self.user])
         message_1 = MessageFactory(room=room_1)
@@ -91,21 +194,425 @@ class TestChat(APITestCase):
         message_2 = MessageFactory(room=room_2)
         message_3 = MessageFactory(room=room_2)
 
-        assert not message_1.users_who_viewed.filter(pk=self.user.pk).exists()
-        assert not message_2.users_who_viewed.filter(pk=self.user.pk).exists()
+        membership_1 = room_1.memberships.get(user=self.user)
+        membership_2 = room_2.memberships.get(user=self.user)
+        assert membership_1.unread_count == 1
+        assert membership_2.unread_count == 2
 
-        with self.assertNumQueries(5):
+        # Watermark UPDATE, its changelog entry for sync and the members whose room lists are stale
+        with self.assertNumQueries(3):
             resp = self.client.post(reverse('room-viewed-all-messages', args=(room_1.pk,)))
             assert resp.status_code == 200
 
-        assert message_1.users_who_viewed.filter(pk=self.user.pk).exists()
-        assert not message_2.users_who_viewed.filter(pk=self.user.pk).exists()
-        assert not message_3.users_who_viewed.filter(pk=self.user.pk).exists()
+        membership_1.refresh_from_db()
+        membership_2.refresh_from_db()
+        assert membership_1.unread_count == 0
+        assert membership_1.last_read_at >= message_1.created_when
+        assert membership_2.unread_count == 2
+        assert membership_2.last_read_at is None
 
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(3):
             resp = self.client.post(reverse('room-viewed-all-messages', args=(room_2.pk,)))
             assert resp.status_code == 200
 
-        assert message_1.users_who_viewed.filter(pk=self.user.pk).exists()
-        assert message_2.users_who_viewed.filter(pk=self.user.pk).exists()
-        assert message_3.users_who_viewed.filter(pk=self.user.pk).exists()
+        membership_2.refresh_from_db()
+        assert membership_2.unread_count == 0
+        assert membership_2.last_read_at >= message_3.created_when
+
+        resp = self.client.get(reverse('room-list'))
+        for room in resp.json()['results']:
+            assert room['unread_count'] == 0
+            for message in room['messages']:
+                assert self.user.pk in message['users_who_viewed']
+        assert message_2.pk in [message['id'] for room in resp.json()['results'] for message in room['messages']]
+
+    def test_cannot_mark_messages_viewed_in_room_user_is_not_a_member_of(self):
+        room = RoomFactory(members=[UserFactory()])
+        resp = self.client.post(reverse('room-viewed-all-messages', args=(room.pk,)))
+        assert resp.status_code == 404
+        resp = self.client.post(reverse('room-viewed-all-messages', args=(room.pk,)), {'message': MessageFactory(room=room).pk})
+        assert resp.status_code == 404
+
+    def test_mark_messages_viewed_up_to_a_message(self):
+        now = timezone.now()
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        messages = [MessageFactory(room=room, user=other_user, created_when=now - timedelta(minutes=minutes)) for minutes in (3, 2, 1)]
+        url = reverse('room-viewed-all-messages', args=(room.pk,))
+
+        # Looking up the message (and membership), the watermark UPDATE, changelog entry and
+        # the members whose room lists are stale
+        with self.assertNumQueries(4):
+            resp = self.client.post(url, {'message': messages[1].pk})
+            assert resp.status_code == 200
+        membership = room.memberships.get(user=self.user)
+        assert membership.last_read_at == messages[1].created_when
+        assert membership.unread_count == 1
+
+        # Never moves backwards
+        self.client.post(url, {'message': messages[0].pk})
+        membership.refresh_from_db()
+        assert (membership.last_read_at, membership.unread_count) == (messages[1].created_when, 1)
+
+        assert self.client.post(url, {'message': 'nope'}).status_code == 400
+        assert self.client.post(url, {'message': MessageFactory().pk}).status_code == 400
+
+    def test_unread_count_tracks_messages_from_other_members(self):
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        message = MessageFactory(room=room, user=other_user)
+        MessageFactory(room=room, user=other_user)
+
+        resp = self.client.get(reverse('room-list'))
+        data = resp.json()['results'][0]
+        assert data['unread_count'] == 2
+        assert data['last_read_at'] is None
+        assert data['messages'][0]['users_who_viewed'] == [other_user.pk]
+
+        # Replying means you've read everything before it
+        MessageFactory(room=room, user=self.user)
+        resp = self.client.get(reverse('room-list'))
+        data = resp.json()['results'][0]
+        assert data['unread_count'] == 0
+        assert data['last_read_at']
+        assert message.pk in [message['id'] for message in data['messages'] if self.user.pk in message['users_who_viewed']]
+
+    def test_room_list_message_limit_only_returns_latest_messages(self):
+        room_1 = RoomFactory(members=[self.user])
+        room_1_messages = [MessageFactory(room=room_1) for _ in range(5)]
+        room_2 = RoomFactory(members=[self.user])
+        room_2_messages = [MessageFactory(room=room_2)]
+
+        resp = self.client.get(reverse('room-list'), data={'message_limit': 2})
+        assert resp.status_code == 200
+        data = {room['id']: room for room in resp.json()['results']}
+        assert [message['id'] for message in data[room_1.pk]['messages']] == [message.pk for message in room_1_messages[-2:]]
+        assert [message['id'] for message in data[room_2.pk]['messages']] == [message.pk for message in room_2_messages]
+
+        resp = self.client.get(reverse('room-list'), data={'message_limit': 0})
+        assert resp.status_code == 200
+        assert all(room['messages'] == [] for room in resp.json()['results'])
+
+        resp = self.client.get(reverse('room-list'), data={'message_limit': 'lots'})
+        assert resp.status_code == 400
+
+    def test_room_messages_are_cursor_paginated(self):
+        room = RoomFactory(members=[self.user])
+        messages = [MessageFactory(room=room) for _ in range(5)]
+        MessageFactory(room=RoomFactory(members=[self.user]))
+
+        resp = self.client.get(reverse('room-messages', args=(room.pk,)), data={'page_size': 2})
+        assert resp.status_code == 200
+        received = [message['id'] for message in resp.json()['results']]
+
+        while resp.json()['next']:
+            resp = self.client.get(resp.json()['next'])
+            assert resp.status_code == 200
+            received += [message['id'] for message in resp.json()['results']]
+
+        # Newest first, every message exactly once
+        assert received == [message.pk for message in reversed(messages)]
+
+    def test_room_messages_requires_membership(self):
+        room = RoomFactory(members=[UserFactory()])
+        MessageFactory(room=room)
+
+        resp = self.client.get(reverse('room-messages', args=(room.pk,)))
+        assert resp.status_code == 404
+
+        resp = self.client.get(reverse('room-messages', args=(RoomFactory(members=[self.user]).pk,)), data={'cursor': 'nope'})
+        assert resp.status_code == 404
+
+    def test_chat_message_serializer_does_not_look_up_sender_or_room(self):
+        room = RoomFactory(members=[self.user])
+        serializer = ChatMessageSerializer(
+            data={'room': room.pk, 'text': 'hello', 'user': UserFactory().pk},
+            context={'user': self.user, 'room_pks': {room.pk}},
+        )
+        # Savepoint, insert, room and membership updates, members whose room lists are now stale
+        # and the savepoint release
+        with self.assertNumQueries(6):
+            assert serializer.is_valid()
+            message = serializer.save()
+        assert message.user == self.user
+        assert message.room_id == room.pk
+
+        serializer = ChatMessageSerializer(data={'room': room.pk, 'text': 'hello'}, context={'user': self.user, 'room_pks': set()})
+        with self.assertNumQueries(0):
+            assert not serializer.is_valid()
+        assert serializer.errors == {'non_field_errors': ['Cannot send messages to chat rooms that you are not a member of.']}
+
+    def test_recording_a_batch_of_messages_keeps_each_members_read_state(self):
+        other_user, quiet_user = UserFactory(), UserFactory()
+        room = RoomFactory(members=[self.user, other_user, quiet_user])
+        messages = [
+            Message(room=room, user=user, text='hi', created_when=timezone.now() + timedelta(seconds=i))
+            for i, user in enumerate([self.user, other_user, self.user, other_user, other_user])
+        ]
+        Message.objects.bulk_create(messages)
+        messages = list(room.messages.order_by('created_when'))
+
+        with self.assertNumQueries(3):
+            Message.objects.update_room_state(messages)
+
+        memberships = {membership.user_id: membership for membership in room.memberships.all()}
+        assert memberships[self.user.pk].unread_count == 2
+        assert memberships[self.user.pk].last_read_at == messages[2].created_when
+        assert memberships[other_user.pk].unread_count == 0
+        assert memberships[other_user.pk].last_read_at == messages[4].created_when
+        assert memberships[quiet_user.pk].unread_count == 5
+        assert memberships[quiet_user.pk].last_read_at is None
+        room.refresh_from_db()
+        assert room.last_message == messages[4]
+
+    def test_recording_a_rooms_read_receipts_is_one_update(self):
+        other_user, third_user = UserFactory(), UserFactory()
+        room = RoomFactory(members=[self.user, other_user, third_user])
+        other_room = RoomFactory(members=[self.user, other_user])
+        messages = [
+            MessageFactory(room=room, user=self.user, created_when=timezone.now() + timedelta(seconds=i))
+            for i in range(4)
+        ]
+        MessageFactory(room=other_room, user=other_user)
+
+        with self.assertNumQueries(1):
+            RoomMembership.objects.record_reads(room.pk, {
+                other_user.pk: messages[1].created_when,
+                third_user.pk: messages[3].created_when,
+            })
+        RoomMembership.objects.record_reads(other_room.pk, {self.user.pk: timezone.now() + timedelta(seconds=10)})
+
+        memberships = {(m.room_id, m.user_id): m for m in RoomMembership.objects.all()}
+        assert memberships[room.pk, other_user.pk].unread_count == 2
+        assert memberships[room.pk, other_user.pk].last_read_at == messages[1].created_when
+        assert memberships[room.pk, third_user.pk].unread_count == 0
+        assert memberships[other_room.pk, self.user.pk].unread_count == 0
+
+        # Late receipts don't move the watermark back
+        RoomMembership.objects.record_reads(room.pk, {third_user.pk: messages[0].created_when})
+        assert RoomMembership.objects.get(room=room, user=third_user).last_read_at == messages[3].created_when
+
+    def test_room_members_are_serialized_once_per_response(self):
+        other_user = UserFactory()
+        for _ in range(3):
+            RoomFactory(members=[self.user, other_user, UserFactory()])
+
+        with patch.object(ChatUserSerializer, 'to_representation', autospec=True, side_effect=ChatUserSerializer.to_representation) as to_representation:
+            resp = self.client.get(reverse('room-list'), {'message_limit': 0})
+        assert resp.status_code == 200
+
+        # self.user, other_user and one extra member per room
+        assert to_representation.call_count == 5
+        for room in resp.json()['results']:
+            assert {member['id'] for member in room['members']} >= {self.user.pk, other_user.pk}
+            assert all(set(member) == {'id', 'first_name', 'last_name', 'avatar'} for member in room['members'])
+
+    def test_member_choices_are_capped_and_only_load_pk_and_username(self):
+        UserFactory.create_batch(3)
+        members = RoomSerializer().fields['members']
+
+        with override_settings(CKC_CHAT_CHOICES_LIMIT=2), CaptureQueriesContext(connection) as queries:
+            choices = members.get_choices()
+
+        assert len(choices) == 2
+        assert len(queries) == 1
+        assert 'first_name' not in queries[0]['sql']
+        user = User.objects.get(pk=next(iter(choices)))
+        assert choices[user.pk] == user.email
+
+        # The browsable API's own cutoff still applies below the limit
+        assert len(members.get_choices(cutoff=1)) == 1
+
+    def test_partial_setting_overrides_keep_nested_defaults(self):
+        with override_settings(CKC_CHAT_RATE_LIMITS={'ROOM': {'RATE': 10}, 'USER': None}):
+            assert chat_settings['RATE_LIMITS'] == {
+                'SOCKET': {'RATE': 5, 'BURST': 20},
+                'USER': None,
+                'ROOM': {'RATE': 10, 'BURST': 100},
+            }
+            assert room_buckets.get(1).wait_time(time.monotonic()) == 0
+
+    def test_room_presence(self):
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        set_presence(other_user.pk, 'away')
+
+        resp = self.client.get(reverse('room-presence', args=[room.pk]))
+        assert resp.status_code == 200
+        presence = {state['user']: state for state in resp.json()}
+        assert presence[other_user.pk]['status'] == 'away'
+        assert presence[other_user.pk]['last_seen']
+        assert presence[self.user.pk] == {'user': self.user.pk, 'status': 'offline', 'last_seen': None}
+
+        resp = self.client.get(reverse('room-presence', args=[RoomFactory(members=[other_user]).pk]))
+        assert resp.status_code == 404
+
+    def test_sync_returns_only_what_changed_since_the_token(self):
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        quiet_room = RoomFactory(members=[self.user, other_user])
+        MessageFactory(room=quiet_room)
+        left_room = RoomFactory(members=[self.user, other_user])
+
+        token = self.client.get(reverse('room-sync')).json()['token']
+
+        message = MessageFactory(room=room, user=other_user)
+        MessageFactory(room=RoomFactory(members=[other_user]))
+        read_receipt_writer.write({room.pk: {other_user.pk: timezone.now()}})
+        left_room.members.remove(self.user)
+
+        resp = self.client.get(reverse('room-sync'), {'since': token})
+        assert resp.status_code == 200
+        data = resp.json()
+        assert data['more'] is False
+        assert [room_data['id'] for room_data in data['rooms']] == [room.pk]
+        read_states = {state['user']: state['last_read_at'] for state in data['rooms'][0]['read_states']}
+        assert read_states[other_user.pk] is not None
+        assert data['left_rooms'] == [left_room.pk]
+        assert [message_data['id'] for message_data in data['messages']] == [message.pk]
+        assert data['messages'][0]['uuid'] == str(message.uuid)
+
+        # Nothing new since the returned token
+        data = self.client.get(reverse('room-sync'), {'since': data['token']}).json()
+        assert (data['rooms'], data['left_rooms'], data['messages']) == ([], [], [])
+
+    def test_sync_is_paginated(self):
+        room = RoomFactory(members=[self.user, UserFactory()])
+        token = self.client.get(reverse('room-sync')).json()['token']
+        messages = [MessageFactory(room=room) for _ in range(3)]
+
+        seen = []
+        with override_settings(CKC_CHAT_SYNC_PAGE_SIZE=2):
+            data = {'more': True, 'token': token}
+            while data['more']:
+                data = self.client.get(reverse('room-sync'), {'since': data['token']}).json()
+                seen += [message_data['id'] for message_data in data['messages']]
+        assert seen == [message.pk for message in messages]
+
+        resp = self.client.get(reverse('room-sync'), {'since': 'nope'})
+        assert resp.status_code == 400
+
+    def test_search_ranks_messages_in_the_users_rooms(self):
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        other_room = RoomFactory(members=[self.user, other_user])
+        best = MessageFactory(room=room, user=other_user, text='Lunch? lunch at noon, lunch!')
+        good = MessageFactory(room=other_room, text='is anyone up for a long lunch at the café near the office')
+        MessageFactory(room=room, text='dinner at noon')
+        MessageFactory(room=RoomFactory(members=[other_user]), text='lunch at noon')
+
+        resp = self.client.get(reverse('room-search'), {'q': 'LUNCH noon'})
+        assert resp.status_code == 200
+        assert [message_data['id'] for message_data in resp.json()['results']] == [best.pk]
+
+        data = self.client.get(reverse('room-search'), {'q': 'lunch'}).json()
+        assert [message_data['id'] for message_data in data['results']] == [best.pk, good.pk]
+        assert data['results'][0]['users_who_viewed'] == [other_user.pk]
+
+        # Only the given room, diacritics are ignored and FTS syntax is just text
+        data = self.client.get(reverse('room-search'), {'q': 'cafe AND "lunch', 'room': room.pk}).json()
+        assert data['results'] == []
+        data = self.client.get(reverse('room-search'), {'q': 'cafe', 'room': other_room.pk}).json()
+        assert [message_data['id'] for message_data in data['results']] == [good.pk]
+
+        # Edits and deletes are reflected right away
+        good.text = 'never mind'
+        good.save()
+        best.delete()
+        assert self.client.get(reverse('room-search'), {'q': 'lunch'}).json()['results'] == []
+
+        assert self.client.get(reverse('room-search'), {'q': '?!'}).status_code == 400
+
+    def test_search_is_keyset_paginated(self):
+        room = RoomFactory(members=[self.user, UserFactory()])
+        messages = [MessageFactory(room=room, text='ping ' + 'pong ' * count) for count in range(5)]
+
+        seen, url = [], reverse('room-search') + '?q=ping&page_size=2'
+        while url:
+            data = self.client.get(url).json()
+            seen += [message_data['id'] for message_data in data['results']]
+            url = data['next']
+        # Shorter messages rank higher
+        assert seen == [message.pk for message in messages]
+
+        assert self.client.get(reverse('room-search'), {'q': 'ping', 'cursor': 'nope'}).status_code == 404
+
+    def test_prune_messages_applies_each_rooms_retention_in_batches(self):
+        now = timezone.now()
+        room = RoomFactory(members=[self.user], retention_days=1)
+        default_room = RoomFactory(members=[self.user])
+        kept = [
+            MessageFactory(room=room, created_when=now - timedelta(hours=1)),
+            MessageFactory(room=default_room, created_when=now - timedelta(days=2)),
+        ]
+        for days in (2, 3, 4):
+            MessageFactory(room=room, created_when=now - timedelta(days=days))
+        MessageFactory(room=default_room, created_when=now - timedelta(days=40))
+
+        stdout = StringIO()
+        with override_settings(CKC_CHAT_RETENTION={'DAYS': 30}):
+            call_command('prune_messages', batch_size=2, sleep=0, stdout=stdout)
+        assert set(Message.objects.all()) == set(kept)
+        assert f'Room {room.pk}: deleted 3 messages' in stdout.getvalue()
+        assert 'Deleted 4 messages' in stdout.getvalue()
+
+    def test_archived_messages_are_read_back_when_scrolling_past_the_database(self):
+        now = timezone.now()
+        room = RoomFactory(members=[self.user], retention_days=1)
+        messages = [MessageFactory(room=room, user=self.user, created_when=now - timedelta(days=days)) for days in (0, 2, 3, 4, 5)]
+
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(CKC_CHAT_RETENTION={'ARCHIVE_DIR': archive_dir}):
+            call_command('prune_messages', archive=True, batch_size=3, sleep=0, stdout=StringIO())
+            assert list(Message.objects.all()) == [messages[0]]
+            assert sorted(archive.count for archive in MessageArchive.objects.all()) == [1, 3]
+
+            seen, url = [], reverse('room-messages', args=[room.pk]) + '?page_size=2'
+            while url:
+                data = self.client.get(url).json()
+                seen += data['results']
+                url = data['next']
+        assert [message_data['id'] for message_data in seen] == [message.pk for message in messages]
+        assert seen[-1]['text'] == messages[-1].text
+        assert seen[-1]['users_who_viewed'] == [self.user.pk]
+
+        with self.assertRaises(CommandError):
+            call_command('prune_messages', archive=True)
+
+    def test_room_list_is_cached_until_something_in_the_rooms_changes(self):
+        other_user = UserFactory()
+        room = RoomFactory(members=[self.user, other_user])
+        MessageFactory(room=room, user=other_user)
+        url = reverse('room-list')
+
+        resp = self.client.get(url)
+        etag = resp['ETag']
+        with self.assertNumQueries(0):
+            assert self.client.get(url).json() == resp.json()
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert resp.status_code == 304
+        assert self.client.get(url, {'message_limit': 0}, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+        # New messages, read state and membership changes are picked up right away
+        for change in (
+            lambda: MessageFactory(room=room, user=other_user),
+            lambda: self.client.post(reverse('room-viewed-all-messages', args=(room.pk,))),
+            lambda: room.members.remove(other_user),
+        ):
+            change()
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            assert resp.status_code == 200
+            etag = resp['ETag']
+        assert [member['id'] for member in resp.json()['results'][0]['members']] == [self.user.pk]
+        assert len(resp.json()['results'][0]['messages']) == 2
+
+        # Including for the members that left
+        other_client = self.client_class()
+        other_client.force_authenticate(other_user)
+        other_room = RoomFactory(members=[self.user, other_user])
+        etag = other_client.get(url)['ETag']
+        other_room.members.remove(other_user)
+        assert other_client.get(url, HTTP_IF_NONE_MATCH=etag).json()['results'] == []
+
+        with override_settings(CKC_CHAT_ROOM_LIST_CACHE={'ENABLED': False}):
+            resp = self.client.get(url)
+            assert 'ETag' not in resp
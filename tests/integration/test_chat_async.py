@@ -1,18 +1,29 @@
 import asyncio
+from unittest import mock
 
+import msgpack
 import pytest
 from django.contrib.sessions.models import Session
 from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, BACKEND_SESSION_KEY, get_user_model
 from django.conf import settings
+from django.core.cache import cache
 from django.test import override_settings
 from channels.routing import get_default_application
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
-from asyncio.exceptions import TimeoutError
+from channels.layers import get_channel_layer
 
+from chit_chat import metrics
+from chit_chat.cache import membership_cache
+from chit_chat.codecs import get_json_codec
 from chit_chat.consumers import ChatRoomConsumer
 from chit_chat.serializers import RoomSerializer
-from chit_chat.models import Message
+from chit_chat.models import Message, RoomMembership
+from chit_chat.notifications import LocMemBackend, notification_dispatcher
+from chit_chat.presence import get_presence, set_presence
+from chit_chat.relay import room_relay
+from chit_chat.replay import replay_buffer
+from chit_chat.writer import message_writer
 from testproject.testapp.factories import RoomFactory, UserFactory
 from testproject.testapp.serializers import ChatTestSerializer
 
@@ -66,13 +77,18 @@ def _get_message_object(**kwargs):
     return Message.objects.get(**kwargs)
 
 
+@database_sync_to_async
+def _get_room_membership(**kwargs):
+    return RoomMembership.objects.get(**kwargs)
+
+
 # ----------------------------------------------------------------------------
 # Websocket helper functions
 # ----------------------------------------------------------------------------
-async def create_websocket_communicator(session_id):
+async def create_websocket_communicator(session_id, path='/ws/chatroom/'):
     communicator = WebsocketCommunicator(
         get_default_application(),
-        '/ws/chatroom/',
+        path,
         headers=[('cookie'.encode(), f'sessionid={session_id}'.encode())]
     )
     connected, subprotocol = await communicator.connect(timeout=5)
@@ -167,12 +183,14 @@ async def test_serializer_hook():
 
     resp = await communicator.receive_json_from()
     resp.pop('time')
+    message = (await get_messages_from_room(room))[-1]
     assert resp == {
         'room': room.pk,
         'text': 'hello',
         'type': 'chat',
         'user': user.pk,
-        'id': (await get_messages_from_room(room))[-1].id,
+        'id': message.id,
+        'uuid': str(message.uuid),
         'users_who_viewed': [user.pk],
     }
 
@@ -283,13 +301,11 @@ async def test_chat_message_proliferates_to_correct_chatroom():
     assert response['room'] == room.pk
 
     # This user should not receive a message
-    try:
-        await unrelated_communicator.receive_json_from()
-    except TimeoutError:
-        pass
+    assert await unrelated_communicator.receive_nothing()
 
     await communicator.disconnect()
     await other_communicator.disconnect()
+    await unrelated_communicator.disconnect()
 
 
 @pytest.mark.asyncio
@@ -317,7 +333,13 @@ async def test_chat_message_proliferates_to_users_who_connected_before_room_was_
     await asyncio.sleep(0.1)
 
     # Message is marked as read by the sender
-    await _get_message_object(user=user, users_who_viewed__in=[user])
+    message = await _get_message_object(user=user, room=room)
+    membership = await _get_room_membership(user=user, room=room)
+    assert membership.last_read_at == message.created_when
+    assert membership.unread_count == 0
+    other_membership = await _get_room_membership(user=other_user, room=room)
+    assert other_membership.last_read_at is None
+    assert other_membership.unread_count == 1
 
     # Other user receives message
     response = await other_communicator.receive_json_from()
@@ -332,10 +354,627 @@ async def test_chat_message_proliferates_to_users_who_connected_before_room_was_
     assert response['users_who_viewed'] == [user.pk]
 
     # This user should not receive a message
+    assert await unrelated_communicator.receive_nothing()
+
+    await communicator.disconnect()
+    await other_communicator.disconnect()
+    await unrelated_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_refresh_group_add_only_joins_new_rooms():
+    user, session_key = await create_user()
+    room = await create_room(members=[user])
+    communicator = await create_websocket_communicator(session_key)
+
+    # Membership comes from the cache after the first connect
+    assert membership_cache.get(user.pk) == {room.pk: 1}
+
+    layer = get_channel_layer()
+    with mock.patch.object(layer, 'group_add', wraps=layer.group_add) as group_add:
+        await layer.group_send(f'user-{user.pk}', {'type': 'refresh_group_add', 'rooms': [room.pk, room.pk + 1000]})
+        # Wait for the event to be handled
+        await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'hello'})
+        await communicator.receive_json_from()
+    assert [call.args[0] for call in group_add.call_args_list] == [str(room.pk + 1000)]
+
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_connect_joins_rooms_through_batched_layer_api_and_records_latency():
+    user, session_key = await create_user()
+    rooms = [await create_room(members=[user]) for _ in range(3)]
+
+    layer = get_channel_layer()
+    layer.group_add_many = mock.AsyncMock()
     try:
-        await unrelated_communicator.receive_json_from()
-    except TimeoutError:
-        pass
+        communicator = await create_websocket_communicator(session_key)
+        layer.group_add_many.assert_awaited_once()
+        groups, channel_name = layer.group_add_many.await_args.args
+        assert sorted(groups) == sorted(str(room.pk) for room in rooms)
+    finally:
+        del layer.group_add_many
+
+    assert metrics.connect_seconds.percentile(99, label='<=10') is not None
+
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_write_behind_broadcasts_before_saving_and_saves_in_batches():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+    communicator = await create_websocket_communicator(session_key)
+
+    with override_settings(CKC_CHAT_WRITE_BEHIND={'ENABLED': True, 'FLUSH_INTERVAL': 0.2}):
+        for text in ('one', 'two', 'three'):
+            await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': text})
+        responses = [await communicator.receive_json_from() for _ in range(3)]
+
+        # Broadcast right away, identified by uuid until they are saved
+        assert [resp['text'] for resp in responses] == ['one', 'two', 'three']
+        assert all(resp['id'] is None and resp['uuid'] for resp in responses)
+        assert await get_messages_from_room(room) == []
+
+        await message_writer.drain()
+
+    messages = await get_messages_from_room(room)
+    assert [str(message.uuid) for message in messages] == [resp['uuid'] for resp in responses]
+
+    membership = await _get_room_membership(user=user, room=room)
+    assert membership.unread_count == 0
+    assert membership.last_read_at == messages[-1].created_when
+    other_membership = await _get_room_membership(user=other_user, room=room)
+    assert other_membership.unread_count == 3
+
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+@pytest.mark.parametrize('codec', [
+    'chit_chat.codecs.StdlibJSONCodec',
+    'chit_chat.codecs.OrjsonCodec',
+])
+async def test_chat_payload_is_serialized_once_for_the_whole_room(codec):
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+
+    with override_settings(CKC_CHAT_JSON_CODEC=codec):
+        communicator = await create_websocket_communicator(session_key)
+        other_communicator = await create_websocket_communicator(other_session_key)
+
+        json_codec = get_json_codec()
+        with mock.patch.object(json_codec, 'dumps', wraps=json_codec.dumps) as dumps:
+            await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'hello'})
+            assert (await communicator.receive_json_from())['text'] == 'hello'
+            assert (await other_communicator.receive_json_from())['text'] == 'hello'
+        assert dumps.call_count == 1
+
+        await communicator.send_to(bytes_data=b'\xff\xfe')
+        assert await communicator.receive_json_from() == {'non_field_errors': ['Invalid JSON.']}
+
+        await communicator.disconnect()
+        await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_msgpack_subprotocol_uses_binary_frames_with_short_keys():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+
+    communicator = WebsocketCommunicator(
+        get_default_application(),
+        '/ws/chatroom/',
+        headers=[('cookie'.encode(), f'sessionid={session_key}'.encode())],
+        subprotocols=[ChatRoomConsumer.MSGPACK_SUBPROTOCOL],
+    )
+    connected, subprotocol = await communicator.connect(timeout=5)
+    assert connected
+    assert subprotocol == ChatRoomConsumer.MSGPACK_SUBPROTOCOL
+    json_communicator = await create_websocket_communicator(other_session_key)
+
+    await communicator.send_to(bytes_data=msgpack.packb({'m': 'chat', 'r': room.pk, 't': 'hello'}))
+    resp = msgpack.unpackb(await communicator.receive_from())
+    assert resp['y'] == 'chat'
+    assert resp['t'] == 'hello'
+    assert resp['u'] == user.pk
+    assert resp['r'] == room.pk
+
+    # JSON clients in the same room are unaffected
+    resp = await json_communicator.receive_json_from()
+    assert resp['text'] == 'hello'
+
+    await communicator.send_to(bytes_data=b'\xc1')
+    assert msgpack.unpackb(await communicator.receive_from()) == {'e': ['Invalid MessagePack.']}
+
+    await communicator.disconnect()
+    await json_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_chat_works_over_sharded_in_memory_layer():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+
+    with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chit_chat.layers.ShardedInMemoryChannelLayer'}}):
+        communicator = await create_websocket_communicator(session_key)
+        other_communicator = await create_websocket_communicator(other_session_key)
+
+        await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'hello'})
+        for receiver in (other_communicator, communicator):
+            response = await receiver.receive_json_from()
+            assert response['text'] == 'hello'
+            assert response['room'] == room.pk
+
+        await communicator.disconnect()
+        await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_typing_is_coalesced_and_not_echoed_to_the_sender():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+    communicator = await create_websocket_communicator(session_key)
+    other_communicator = await create_websocket_communicator(other_session_key)
+
+    for _ in range(3):
+        await communicator.send_json_to({'message_type': 'typing', 'room': room.pk})
+    await communicator.send_json_to({'message_type': 'typing', 'room': room.pk, 'is_typing': False})
+
+    response = await other_communicator.receive_json_from()
+    assert response == {'type': 'typing', 'user': user.pk, 'room': room.pk, 'is_typing': True}
+    # Repeats within the interval were dropped, the state change went through
+    response = await other_communicator.receive_json_from()
+    assert response['is_typing'] is False
+    assert await other_communicator.receive_nothing()
+    assert await communicator.receive_nothing()
+
+    # Same membership check as chat messages
+    unrelated_room = await create_room(members=[other_user])
+    await communicator.send_json_to({'message_type': 'typing', 'room': unrelated_room.pk})
+    response = await communicator.receive_json_from()
+    assert response['field_errors']['room'] == ['Cannot send messages to chat rooms that you are not a member of.']
 
     await communicator.disconnect()
     await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_presence_is_fanned_out_to_every_room_and_kept_in_cache():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    rooms = [await create_room(members=[user, other_user]) for _ in range(2)]
+    communicator = await create_websocket_communicator(session_key)
+    other_communicator = await create_websocket_communicator(other_session_key)
+    # Connecting records presence without broadcasting it
+    assert get_presence([user.pk])[user.pk]['status'] == 'online'
+    assert await other_communicator.receive_nothing()
+
+    await communicator.send_json_to({'message_type': 'presence', 'status': 'away'})
+    await communicator.send_json_to({'message_type': 'presence', 'status': 'away'})
+    # Once per room the user is in
+    for _ in rooms:
+        response = await other_communicator.receive_json_from()
+        assert response['type'] == 'presence'
+        assert response['user'] == user.pk
+        assert response['status'] == 'away'
+    assert await other_communicator.receive_nothing()
+    assert await communicator.receive_nothing()
+    assert get_presence([user.pk])[user.pk]['status'] == 'away'
+
+    await communicator.send_json_to({'message_type': 'presence', 'status': 'asleep'})
+    response = await communicator.receive_json_from()
+    assert 'status' in response['field_errors']
+
+    # Having announced itself, the socket announces leaving too
+    await communicator.disconnect()
+    for _ in rooms:
+        response = await other_communicator.receive_json_from()
+        assert response['status'] == 'offline'
+    assert get_presence([user.pk])[user.pk]['status'] == 'offline'
+
+    await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_presence_is_broadcast_once_per_interval_with_the_latest_status():
+    cache.clear()
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    await create_room(members=[user, other_user])
+
+    with override_settings(CKC_CHAT_PRESENCE={'INTERVAL': 0.5}):
+        communicator = await create_websocket_communicator(session_key)
+        other_communicator = await create_websocket_communicator(other_session_key)
+        await communicator.send_json_to({'message_type': 'presence', 'status': 'away'})
+        assert (await other_communicator.receive_json_from())['status'] == 'away'
+
+        # Connecting from another device doesn't override it
+        second_communicator = await create_websocket_communicator(session_key)
+        assert get_presence([user.pk])[user.pk]['status'] == 'away'
+
+        # Flapping within the interval, only the last status goes out once it's over
+        for status in ('online', 'away', 'online'):
+            await communicator.send_json_to({'message_type': 'presence', 'status': status})
+        assert await other_communicator.receive_nothing()
+        assert (await other_communicator.receive_json_from(timeout=1))['status'] == 'online'
+        assert await other_communicator.receive_nothing()
+
+        await second_communicator.disconnect()
+        await communicator.disconnect()
+        assert (await other_communicator.receive_json_from())['status'] == 'offline'
+        await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_flooding_socket_is_rate_limited_before_saving_anything():
+    user, session_key = await create_user()
+    room = await create_room(members=[user])
+    limited_before = metrics.rate_limited.snapshot().get('socket', 0)
+
+    with override_settings(CKC_CHAT_RATE_LIMITS={'SOCKET': {'RATE': 0.01, 'BURST': 2}}):
+        communicator = await create_websocket_communicator(session_key)
+        for text in ('one', 'two', 'three'):
+            await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': text})
+
+        # The error may overtake the broadcasts, which go through the channel layer
+        responses = [await communicator.receive_json_from() for _ in range(3)]
+        assert [response['text'] for response in responses if 'text' in response] == ['one', 'two']
+        error = next(response for response in responses if 'text' not in response)
+        assert error['non_field_errors'][0].startswith('Too many messages')
+        assert error['retry_after'] > 0
+        await communicator.disconnect()
+
+    assert [message.text for message in await get_messages_from_room(room)] == ['one', 'two']
+    assert metrics.rate_limited.snapshot()['socket'] == limited_before + 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_room_rate_limit_is_shared_by_its_members():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+
+    with override_settings(CKC_CHAT_RATE_LIMITS={'ROOM': {'RATE': 0.01, 'BURST': 1}}):
+        communicator = await create_websocket_communicator(session_key)
+        other_communicator = await create_websocket_communicator(other_session_key)
+
+        await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'first'})
+        assert (await other_communicator.receive_json_from())['text'] == 'first'
+        await other_communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'second'})
+        response = await other_communicator.receive_json_from()
+        assert 'retry_after' in response
+        # However the room is spelled
+        await other_communicator.send_json_to({'message_type': 'chat', 'room': str(room.pk), 'text': 'third'})
+        response = await other_communicator.receive_json_from()
+        assert 'retry_after' in response
+
+        await communicator.disconnect()
+        await other_communicator.disconnect()
+
+    assert [message.text for message in await get_messages_from_room(room)] == ['first']
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_read_receipts_are_saved_and_announced_in_one_batch_per_room():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+
+    with override_settings(CKC_CHAT_READ_RECEIPTS={'FLUSH_INTERVAL': 0.2}):
+        communicator = await create_websocket_communicator(session_key)
+        other_communicator = await create_websocket_communicator(other_session_key)
+
+        for _ in range(3):
+            await communicator.send_json_to({'message_type': 'read', 'room': room.pk})
+        await other_communicator.send_json_to({'message_type': 'read', 'room': room.pk, 'time': '2020-01-01T00:00:00Z'})
+
+        # Everyone's receipts arrive together, once
+        for receiver in (communicator, other_communicator):
+            response = await receiver.receive_json_from()
+            assert response['type'] == 'read'
+            assert response['room'] == room.pk
+            assert sorted(reader['user'] for reader in response['readers']) == [user.pk, other_user.pk]
+            assert await receiver.receive_nothing()
+
+        membership = await _get_room_membership(room=room, user=other_user)
+        assert membership.last_read_at.year == 2020
+        assert (await _get_room_membership(room=room, user=user)).last_read_at > membership.last_read_at
+
+        # Stale receipts are saved as no-ops and never announced
+        await other_communicator.send_json_to({'message_type': 'read', 'room': room.pk, 'time': '2019-01-01T00:00:00Z'})
+        await communicator.send_json_to({'message_type': 'read', 'room': room.pk})
+        for receiver in (communicator, other_communicator):
+            response = await receiver.receive_json_from()
+            assert [reader['user'] for reader in response['readers']] == [user.pk]
+            assert await receiver.receive_nothing()
+        assert (await _get_room_membership(room=room, user=other_user)).last_read_at.year == 2020
+
+        await communicator.disconnect()
+        await other_communicator.disconnect()
+
+
+@database_sync_to_async
+def create_messages(room, user, *texts):
+    return [Message.objects.create(room=room, user=user, text=text) for text in texts]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_reconnecting_socket_is_sent_missed_messages_from_the_replay_buffer():
+    replay_buffer.clear()
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+
+    # Keeps the room's buffer filling while the first socket is away
+    other_communicator = await create_websocket_communicator(other_session_key)
+    communicator = await create_websocket_communicator(session_key)
+    await other_communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'seen'})
+    seen = await communicator.receive_json_from()
+    await other_communicator.receive_json_from()
+    await communicator.disconnect()
+
+    for text in ('one', 'two'):
+        await other_communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': text})
+        await other_communicator.receive_json_from()
+
+    with mock.patch('chit_chat.consumers.get_missed_messages') as get_missed_messages:
+        communicator = await create_websocket_communicator(session_key, f'/ws/chatroom/?last_seen={room.pk}:{seen["id"]}')
+        assert [(await communicator.receive_json_from())['text'] for _ in range(2)] == ['one', 'two']
+        assert await communicator.receive_nothing()
+        get_missed_messages.assert_not_called()
+
+    await other_communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'live'})
+    assert (await communicator.receive_json_from())['text'] == 'live'
+
+    await communicator.disconnect()
+    await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_reconnecting_socket_is_sent_missed_messages_from_the_database():
+    replay_buffer.clear()
+    user, session_key = await create_user()
+    room = await create_room(members=[user])
+    busy_room = await create_room(members=[user])
+    unknown_room = await create_room(members=[user])
+    seen, *missed = await create_messages(room, user, 'seen', 'one', 'two')
+    busy_seen, *_ = await create_messages(busy_room, user, 'seen', 'one', 'two', 'three')
+
+    last_seen = f'{room.pk}:{seen.pk},{busy_room.pk}:{busy_seen.pk},{unknown_room.pk}:{busy_seen.pk},garbage'
+    with override_settings(CKC_CHAT_REPLAY={'MAX_MESSAGES': 2}):
+        communicator = await create_websocket_communicator(session_key, f'/ws/chatroom/?last_seen={last_seen}')
+        responses = [await communicator.receive_json_from() for _ in range(4)]
+        assert await communicator.receive_nothing()
+
+    assert [(response['id'], response['text']) for response in responses[:2]] == [(message.pk, message.text) for message in missed]
+    assert responses[0]['users_who_viewed'] == [user.pk]
+    # Too many to replay in one room, and a message id from another room
+    assert sorted(response['room'] for response in responses[2:]) == [busy_room.pk, unknown_room.pk]
+    assert {response['type'] for response in responses[2:]} == {'resync'}
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_large_rooms_are_relayed_through_one_group_membership_per_process():
+    user, session_key = await create_user()
+    relayed_user, relayed_session_key = await create_user()
+    other_relayed_user, other_relayed_session_key = await create_user()
+    room = await create_room(members=[user, relayed_user, other_relayed_user])
+    layer = get_channel_layer()
+
+    # Joined the room's group before it counted as large, and keeps it
+    communicator = await create_websocket_communicator(session_key)
+    with override_settings(CKC_CHAT_LARGE_ROOM_MEMBERS=3):
+        relayed_communicator = await create_websocket_communicator(relayed_session_key)
+        other_relayed_communicator = await create_websocket_communicator(other_relayed_session_key)
+    assert len(layer.groups[str(room.pk)]) == 2
+
+    await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'hello'})
+    for receiver in (communicator, relayed_communicator, other_relayed_communicator):
+        assert (await receiver.receive_json_from())['text'] == 'hello'
+        assert await receiver.receive_nothing()
+
+    # Events without a room of their own are routed by the room they were sent to
+    await relayed_communicator.send_json_to({'message_type': 'presence', 'status': 'away'})
+    for receiver in (communicator, other_relayed_communicator):
+        response = await receiver.receive_json_from()
+        assert (response['type'], response['user']) == ('presence', relayed_user.pk)
+
+    await relayed_communicator.disconnect()
+    await other_relayed_communicator.disconnect()
+    assert len(layer.groups[str(room.pk)]) == 1
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_relayed_events_wait_until_the_socket_is_connected():
+    user, session_key = await create_user()
+    relayed_user, relayed_session_key = await create_user()
+    connecting_user, connecting_session_key = await create_user()
+    room = await create_room(members=[user, relayed_user, connecting_user])
+    layer = get_channel_layer()
+
+    communicator = await create_websocket_communicator(session_key)
+    with override_settings(CKC_CHAT_LARGE_ROOM_MEMBERS=1):
+        relayed_communicator = await create_websocket_communicator(relayed_session_key)
+        await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'first'})
+        first_id = (await communicator.receive_json_from())['id']
+        assert (await relayed_communicator.receive_json_from())['text'] == 'first'
+
+        # A real layer takes a while to join the user's group, a message is sent meanwhile
+        group_add = layer.group_add
+
+        async def slow_group_add(*args):
+            await asyncio.sleep(0.2)
+            await group_add(*args)
+
+        with mock.patch.object(layer, 'group_add', slow_group_add):
+            connecting = asyncio.ensure_future(create_websocket_communicator(
+                connecting_session_key, path=f'/ws/chatroom/?last_seen={room.pk}:{first_id}',
+            ))
+            await asyncio.sleep(0.1)
+            await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'second'})
+            connecting_communicator = await connecting
+
+    # Accepted first, then sent the message once
+    assert (await connecting_communicator.receive_json_from())['text'] == 'second'
+    assert await connecting_communicator.receive_nothing()
+
+    await communicator.disconnect()
+    await relayed_communicator.disconnect()
+    await connecting_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_relay_keeps_receiving_after_a_channel_layer_error():
+    user, session_key = await create_user()
+    relayed_user, relayed_session_key = await create_user()
+    room = await create_room(members=[user, relayed_user])
+    layer = get_channel_layer()
+
+    communicator = await create_websocket_communicator(session_key)
+    receive = layer.receive
+    failures = [ConnectionError('gone')]
+
+    async def flaky_receive(channel):
+        if channel == room_relay._channel and failures:
+            raise failures.pop()
+        return await receive(channel)
+
+    with override_settings(CKC_CHAT_LARGE_ROOM_MEMBERS=1), mock.patch('chit_chat.relay.RETRY_DELAY', 0), \
+            mock.patch.object(layer, 'receive', flaky_receive):
+        relayed_communicator = await create_websocket_communicator(relayed_session_key)
+        await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'hello'})
+        assert (await relayed_communicator.receive_json_from())['text'] == 'hello'
+    assert failures == []
+
+    await communicator.disconnect()
+    await relayed_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_offline_members_get_one_digest_per_room():
+    cache.clear()
+    LocMemBackend.outbox.clear()
+    user, session_key = await create_user()
+    online_user, online_session_key = await create_user()
+    offline_user, _ = await create_user()
+    muted_user, _ = await create_user()
+    archived_user, _ = await create_user()
+    room = await create_room(members=[user, online_user, offline_user, muted_user, archived_user])
+    await database_sync_to_async(RoomMembership.objects.filter(room=room, user=muted_user).update)(ignore_notifications=True)
+    await database_sync_to_async(RoomMembership.objects.filter(room=room, user=archived_user).update)(archived=True)
+
+    communicator = await create_websocket_communicator(session_key)
+    online_communicator = await create_websocket_communicator(online_session_key)
+    closed_communicator = await create_websocket_communicator(online_session_key)
+    await closed_communicator.disconnect()
+    # Connected members are left out whatever their presence says
+    await database_sync_to_async(set_presence)(online_user.pk, 'offline')
+    notifications = {'BACKEND': 'chit_chat.notifications.LocMemBackend', 'DIGEST_INTERVAL': 0.2, 'MAX_MESSAGES': 2}
+    with override_settings(CKC_CHAT_NOTIFICATIONS=notifications):
+        for text in ('one', 'two', 'three'):
+            await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': text})
+            await communicator.receive_json_from()
+        assert LocMemBackend.outbox == []
+        await notification_dispatcher.drain()
+
+    [digest] = LocMemBackend.outbox
+    assert (digest['user'], digest['room'], digest['count']) == (offline_user.pk, room.pk, 3)
+    assert [message.text for message in digest['messages']] == ['two', 'three']
+
+    await communicator.disconnect()
+    await online_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_removed_member_can_no_longer_post_or_receive():
+    user, session_key = await create_user()
+    other_user, other_session_key = await create_user()
+    room = await create_room(members=[user, other_user])
+    communicator = await create_websocket_communicator(session_key)
+    other_communicator = await create_websocket_communicator(other_session_key)
+
+    await database_sync_to_async(room.members.remove)(user)
+
+    await communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'still here?'})
+    response = await communicator.receive_json_from()
+    assert 'non_field_errors' in response
+    assert await other_communicator.receive_nothing()
+    assert await get_messages_from_room(room) == []
+
+    await other_communicator.send_json_to({'message_type': 'chat', 'room': room.pk, 'text': 'bye'})
+    assert (await other_communicator.receive_json_from())['text'] == 'bye'
+    assert await communicator.receive_nothing()
+
+    await communicator.disconnect()
+    await other_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_hand_built_chat_events_are_still_delivered():
+    user, session_key = await create_user()
+    room = await create_room(members=[user])
+    communicator = await create_websocket_communicator(session_key)
+
+    # The payload itself, as sent before events were encoded once per room
+    await get_channel_layer().group_send(str(room.pk), {
+        'type': 'chat',
+        'user': user.pk,
+        'room': room.pk,
+        'text': 'from the server',
+        'time': '2022-03-01T12:00:00',
+        'users_who_viewed': [user.pk],
+    })
+    response = await communicator.receive_json_from()
+    assert (response['type'], response['text']) == ('chat', 'from the server')
+
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_users_are_online_until_their_last_socket_closes():
+    cache.clear()
+    user, session_key = await create_user()
+    await create_room(members=[user])
+
+    with override_settings(CKC_CHAT_PRESENCE={'TTL': 0.3}):
+        communicator = await create_websocket_communicator(session_key)
+        other_communicator = await create_websocket_communicator(session_key)
+
+        # Kept alive without the client ever sending presence
+        await asyncio.sleep(0.6)
+        assert get_presence([user.pk])[user.pk]['status'] == 'online'
+
+        await communicator.disconnect()
+        assert get_presence([user.pk])[user.pk]['status'] == 'online'
+        await other_communicator.disconnect()
+        assert get_presence([user.pk])[user.pk]['status'] == 'offline'
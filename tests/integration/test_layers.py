@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from channels.exceptions import ChannelFull
+
+from chit_chat.layers import ShardedInMemoryChannelLayer
+
+
+@pytest.mark.asyncio
+async def test_group_send_reaches_every_member_once():
+    layer = ShardedInMemoryChannelLayer()
+    first, second = await layer.new_channel(), await layer.new_channel()
+    await layer.group_add_many(['1', '2'], first)
+    await layer.group_add('1', second)
+
+    await layer.group_send('1', {'type': 'chat', 'text': 'hello'})
+    assert (await layer.receive(first))['text'] == 'hello'
+    assert (await layer.receive(second))['text'] == 'hello'
+
+    await layer.group_discard_many(['1', '2'], first)
+    await layer.group_send('1', {'type': 'chat', 'text': 'again'})
+    await layer.group_send('2', {'type': 'chat', 'text': 'nobody'})
+    assert (await layer.receive(second))['text'] == 'again'
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(layer.receive(first), 0.05)
+
+
+@pytest.mark.asyncio
+async def test_full_channel_policies():
+    layer = ShardedInMemoryChannelLayer(capacity=2)
+    channel = await layer.new_channel()
+    await layer.group_add('1', channel)
+    for i in range(2):
+        await layer.send(channel, {'type': 'chat', 'i': i})
+    with pytest.raises(ChannelFull):
+        await layer.send(channel, {'type': 'chat', 'i': 2})
+    # Group sends skip full channels
+    await layer.group_send('1', {'type': 'chat', 'i': 3})
+    assert [(await layer.receive(channel))['i'] for _ in range(2)] == [0, 1]
+
+    layer = ShardedInMemoryChannelLayer(capacity=2, full_policy='drop_oldest')
+    for i in range(3):
+        await layer.send(channel, {'type': 'chat', 'i': i})
+    assert [(await layer.receive(channel))['i'] for _ in range(2)] == [1, 2]
+
+    layer = ShardedInMemoryChannelLayer(capacity=1, full_policy='block')
+    await layer.send(channel, {'type': 'chat', 'i': 0})
+    blocked = asyncio.ensure_future(layer.send(channel, {'type': 'chat', 'i': 1}))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    assert (await layer.receive(channel))['i'] == 0
+    await blocked
+    assert (await layer.receive(channel))['i'] == 1
+
+
+@pytest.mark.asyncio
+async def test_channels_nobody_receives_from_are_dropped_from_their_groups():
+    layer = ShardedInMemoryChannelLayer(expiry=0.01, sweep_interval=0, shards=1)
+    dead, alive = await layer.new_channel(), await layer.new_channel()
+    await layer.group_add_many(['1', '2'], dead)
+    await layer.group_add('1', alive)
+
+    await layer.group_send('1', {'type': 'chat', 'i': 0})
+    assert (await layer.receive(alive))['i'] == 0
+    await asyncio.sleep(0.02)
+    await layer.group_send('1', {'type': 'chat', 'i': 1})
+
+    shard = layer.shards[0]
+    assert set(shard.groups['1']) == {alive}
+    assert '2' not in shard.groups
+    assert dead not in shard.channels and dead not in shard.channel_groups
+    assert (await asyncio.wait_for(layer.receive(alive), 1))['i'] == 1
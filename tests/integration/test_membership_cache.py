@@ -0,0 +1,62 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from chit_chat.cache import MembershipCache, membership_cache
+from testproject.testapp.factories import RoomFactory, UserFactory
+
+
+class TestMembershipCache(TestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = MembershipCache()
+        with override_settings(CKC_CHAT_MEMBERSHIP_CACHE={'MAX_SIZE': 2}):
+            cache.set(1, {10: 2})
+            cache.set(2, {20: 2})
+            assert cache.get(1) == {10: 2}
+            cache.set(3, {30: 2})
+
+        assert cache.get(1) == {10: 2}
+        assert cache.get(2) is None
+        assert cache.get(3) == {30: 2}
+
+    def test_entries_expire(self):
+        cache = MembershipCache()
+        with mock.patch('chit_chat.cache.time.monotonic', return_value=100):
+            cache.set(1, {10: 2})
+        with mock.patch('chit_chat.cache.time.monotonic', return_value=159):
+            assert cache.get(1) == {10: 2}
+        with mock.patch('chit_chat.cache.time.monotonic', return_value=161):
+            assert cache.get(1) is None
+
+    def test_membership_changes_invalidate(self):
+        user = UserFactory()
+        room = RoomFactory(members=[user])
+        membership_cache.set(user.pk, {room.pk: 1})
+
+        RoomFactory(members=[user])
+        assert membership_cache.get(user.pk) is None
+
+        membership_cache.set(user.pk, {room.pk: 1})
+        room.members.remove(user)
+        assert membership_cache.get(user.pk) is None
+
+        membership_cache.set(user.pk, {})
+        user.chat_rooms.add(room)
+        assert membership_cache.get(user.pk) is None
+
+    def test_removals_invalidate_again_once_committed(self):
+        user = UserFactory()
+        room = RoomFactory(members=[user])
+
+        with mock.patch('chit_chat.signals.get_channel_layer') as get_channel_layer:
+            get_channel_layer.return_value.group_send = mock.AsyncMock()
+            with self.captureOnCommitCallbacks(execute=True):
+                room.members.remove(user)
+                # A socket reading the rooms before the removal is committed still sees it
+                membership_cache.set(user.pk, {room.pk: 1})
+                get_channel_layer.return_value.group_send.assert_not_called()
+
+        assert membership_cache.get(user.pk) is None
+        get_channel_layer.return_value.group_send.assert_awaited_with(
+            f'user-{user.pk}', {'type': 'refresh_group_discard', 'rooms': [room.pk]},
+        )